@@ -13,9 +13,13 @@
 import json
 import os
 import gc
+import itertools
+import math
 import time
 import re
 from datetime import datetime
+import weakref
+from collections import ChainMap
 from random import randrange as rnd
 
 #ComfyUI Related Imports
@@ -48,6 +52,42 @@ MAX_SLOTS = 6 #Adjust this value to change how many inputs/outputs the dynamic n
 MAIN_CATEGORY = "🐺 VykosX-ControlFlowUtils"
 VYKOSX_STORAGE_DATA = {}
 
+def expression_variables(*layers, hidden=()):
+	"""
+	Build the variables for a safe_eval call without copying anything: names are looked up in the given layers in order
+	and then in MemoryStorage, only when the expression reads them. Assignments made by the expression go to a new empty
+	layer on top, so the dictionaries passed in are never modified.
+	
+	:param layers: Dictionaries of variables, from highest to lowest priority.
+	:param hidden: Names that must not be resolved from MemoryStorage (such as inputs that are still pending).
+	:return: A ChainMap with the variables.
+	"""
+	storage = VYKOSX_STORAGE_DATA
+	if hidden and not storage.keys().isdisjoint(hidden):
+		storage = {key: value for key, value in storage.items() if key not in hidden}
+	return ChainMap({}, *layers, storage)
+
+def cycle_snapshot_directory():
+	"""Folder where the snapshots of Cycles are saved, inside the ComfyUI user folder (or the output folder on older versions)."""
+	return os.path.join(getattr(folder_paths, "get_user_directory", folder_paths.get_output_directory)(), "cycle_snapshots")
+
+#SERVER ROUTES
+#*************
+
+try:
+	from aiohttp import web
+
+	@PromptServer.instance.routes.get("/vykosx/eval_stats")
+	async def eval_stats_route(request):
+		"""Report the expression timings recorded while EVAL_PROFILING is enabled. Add ?reset=1 to clear them afterwards."""
+		report = eval_stats_report()
+		if request.query.get("reset", "") not in ("", "0", "false"):
+			reset_eval_stats()
+		return web.json_response(report)
+
+except Exception as x:
+	debug_print ("[!] UNABLE TO REGISTER THE EVAL STATS ROUTE:",x)
+
 #CUSTOM NODES
 #*************
 
@@ -70,6 +110,7 @@ INTERNAL:
 class Cycle:
 	def __init__(self):
 		self.state = {'index': 0,'step': 1,'end': 0, 'start': 0, 'finish': False, 'auto_reset': True}
+		self.snapshot = "" #Name of the snapshot the state was last restored from
 		pass
 
 	@classmethod
@@ -81,7 +122,8 @@ class Cycle:
 				"end": ("INT", {"default": 10,"defaultInput": False,"tooltip": "The value at which the loop is considered to be finished"})
 			},"optional": {
 				"manual_reset": ("BOOLEAN", {"defaultInput": False,"tooltip": "Enable to force a 'DRY RUN' and reset the Cycle to its first iteration"}),
-				"auto_reset": ("BOOLEAN", {"defaultInput": False, "default": True, "label_on": "Auto Reset on Cycle End", "label_off": "Keep Cycling until Manual Stop", "tooltip": "Enable to have the loop counter automatically reset to Start once it reaches End"})
+				"auto_reset": ("BOOLEAN", {"defaultInput": False, "default": True, "label_on": "Auto Reset on Cycle End", "label_off": "Keep Cycling until Manual Stop", "tooltip": "Enable to have the loop counter automatically reset to Start once it reaches End"}),
+				"snapshot": ("STRING", {"default": "", "defaultInput": False, "tooltip": "Name under which the state of the Cycle is saved after every iteration, so it can resume where it stopped after ComfyUI is restarted.\nLeave empty to keep the state in memory only"}),
 			},"hidden": { "unique_id": "UNIQUE_ID" },
 		}
 
@@ -101,25 +143,37 @@ return True so you can test this with an [IF Selector](#IF_Condition_Selector) n
 
 Set your Start, End and Step parameters to the values you would like to iterate from, to and by, respectively. If you'd like the loop to return automatically to the original Start value, enable the Auto_Reset Input, otherwise the cycle will continue to apply Step to Index on each iteration.
 
+Cycles normally only live in memory, so restarting ComfyUI sends them back to their 'DRY RUN'. Give the Cycle a Snapshot name to have its Index and Data saved to the cycle_snapshots folder of your ComfyUI user folder after every iteration. The first time the Cycle runs after a restart it picks up from the saved state. Images, latents and other tensors are saved as safetensors, loaded models can't be saved and will be None when the Cycle is restored.
+
 HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 """
-	def run(self,start,step,end,manual_reset,auto_reset,unique_id):
+	def run(self,start,step,end,manual_reset,auto_reset,unique_id,snapshot=""):
 
 		debug_print ("\n>> CYCLE [",unique_id,"] INIT!")
 
+		snapshot = re.sub(r"[^\w\-]", "_", snapshot.strip())
+
+		if snapshot != self.snapshot: #Restore the saved state the first time a snapshot is used
+			self.snapshot = snapshot
+			if snapshot and not manual_reset and (state := load_snapshot(cycle_snapshot_directory(), snapshot)) is not None:
+				debug_print (">> CYCLE [",unique_id,"] RESTORED FROM SNAPSHOT '",snapshot,"'!")
+				self.state = state
+
 		if manual_reset or self.state['finish']:
 			if manual_reset or auto_reset:
 
 				debug_print (">> CYCLE [",unique_id,"] RESET!")
 
-				self.state = {'index': None,'step':step,'end': end, 'start': start, 'finish': False, 'auto_reset': auto_reset}
+				self.state = {'index': None,'step':step,'end': end, 'start': start, 'finish': False, 'auto_reset': auto_reset, 'snapshot': snapshot}
 
 				return (self.state,True)
 
+		self.state['snapshot'] = snapshot
+
 		return (self.state,False)
 
 	@classmethod
-	def IS_CHANGED(self, start ,step, end,manual_reset,auto_reset, unique_id):
+	def IS_CHANGED(self, start ,step, end,manual_reset,auto_reset, unique_id, snapshot=""):
 		if manual_reset:
 			self.state = {'index': start,'step':step,'end': end, 'start': start, 'finish': False, 'auto_reset': auto_reset}
 			return float("NaN")
@@ -255,6 +309,8 @@ HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 
 			debug_print (">> CYCLE [",kwargs['unique_id'],"] END - DRY RUN")
 
+			self.save_snapshot(CYCLE)
+
 			return (None,None,)
 
 		debug_print (">> CYCLE [",kwargs['unique_id'],"] ITERATION '", CYCLE['index'],"'!")
@@ -278,8 +334,18 @@ HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 
 		#debug_print ("CYCLE END FINISH, CYCLE=",CYCLE)
 
+		self.save_snapshot(CYCLE)
+
 		return (CYCLE['index'],CYCLE['finished'])
 
+	def save_snapshot(self, CYCLE):
+
+		if CYCLE.get('snapshot'):
+			try:
+				save_snapshot(cycle_snapshot_directory(), CYCLE['snapshot'], CYCLE)
+			except Exception as e:
+				debug_print ("Unable to save the snapshot of CYCLE '", CYCLE['snapshot'], "':", e)
+
 	@classmethod
 	def IS_CHANGED(s, CYCLE, **kwargs):
 
@@ -303,12 +369,17 @@ class LoopOpen:
 				"condition": ("STRING", {"default" : "True", "defaultInput": False, "tooltip": "The loop will be executed only if the specified condition evaluates to True"}),
 			},
 			"optional": {
+				"mode": (["LOOP","MAP","BATCH"], {"default": "LOOP", "tooltip": "LOOP: Run the iterations one after another, passing the Data from each iteration to the next.\nMAP: Run every iteration on the same input Data and gather the results of all of them into lists or batches\nBATCH: Like MAP, but every copy of the loop runs on a chunk of Batch_Size iterations at once, with the input batches split between the chunks"}),
+				"batch_size": ("INT", {"default": 4, "min": 1, "max": 0xffffffff, "defaultInput": False, "tooltip": "How many iterations are run together by each copy of the loop in BATCH mode"}),
 				"index_override": (any_type, {"forceInput": True, "tooltip": "Manually override the current index of the Cycle.\nYou can use this input to have complex Step calculations or to reset the loop manually"}),
 				"data": (any_type, {"forceInput": True, "tooltip": "Any data you wish to iterate on in the loop"}),
 				"aux": (any_type, {"forceInput": True, "tooltip": "Any auxilliary data you wish to iterate on in the loop"}),
 			},"hidden": {
 				"unique_id": "UNIQUE_ID",
 				"original_id": "INT",
+				"map_item": "BOOLEAN",
+				"carried": "INT",
+				"dynprompt": "DYNPROMPT",
 			}
 		}
 
@@ -330,13 +401,23 @@ You can set the Data and Aux Data Inputs to any Data you wish to iterate on for
 
 You can use the Index_Override Input to manually force the loop to skip to a specific index prematurely. If Condition does not evaluate to True for the [Loop Open] node, Execution will be blocked and any nodes following [Loop Open] will not execute.
 
+If the iterations of your Loop don't depend on each other (such as generating one image for every prompt in a list) you can set Mode to MAP. Every iteration from Start to End will then receive the original Data and Aux Inputs of the [Loop Open] node, all the iterations are created at once so ComfyUI is free to run them in any order, and the Outputs of the [Loop Close] node will contain the results of every iteration gathered together: a batch for images and other tensors of the same size, or a list for anything else. In MAP mode the Condition of the [Loop Open] node is only checked for the first iteration, while the Condition of the [Loop Close] node decides which iterations are included in the results. Step can't be 0 in MAP mode.
+
+BATCH mode works like MAP mode for nodes that can process a whole batch at once (such as VAE Decode or an Upscale). Instead of one copy of the loop per iteration, each copy runs on a chunk of Batch_Size iterations: item N of every image, mask or latent batch connected to the [Loop Open] node with one item per iteration belongs to iteration N, and each copy only receives the items of its own chunk. Any other Data, including batches of a different size such as a single reference image, is passed unchanged to every chunk. The results of all the chunks are joined back together in the order of their iterations, and the Condition of the [Loop Close] node decides which chunks are included.
+
 This node uses the new Execution Inversion mechanics and requires an updated version of ComfyUI. It works by dynamically cloning all the nodes that are connected as children of the [Loop Open] and [Loop Close] nodes, while forwarding the data to the copies on each iteration. This is still a bit of proof of concept, so issues may occur. Please report any bugs on the Issues page of this node pack's Github repo!
 
 HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 """
-	def loop(self, start, step, end, condition, **kwargs):
+	payloads = PayloadRegistry() #Data passed on by the [Loop Close] to the next iteration, released once that iteration has started
+
+	def loop(self, start, step, end, condition, mode="LOOP", batch_size=4, **kwargs):
+
+		if kwargs.get("carried") is not None:
+			kwargs.update(self.payloads.take(kwargs.get("dynprompt"), kwargs.pop("carried")))
 
 		if condition=="": condition = True
+		if kwargs.get("map_item", False): condition = "True" #In MAP mode the Condition is only checked on the first iteration
 
 		index = kwargs.get("index_override", start)
 		if index is None: index = start
@@ -350,12 +431,31 @@ HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 			debug_print ("\n>> LOOP [",original_id,"] ITERATION:",index)
 
 		finished = (( end - index ) <= 0) if step >= 0 else (( end - index ) >= 0)
-		loop_status = {"id":original_id,"start":start,"end":end,"step":step,"index":index,"finished":finished,"last_id":kwargs['unique_id']}
+		loop_status = {"id":original_id,"start":start,"end":end,"step":step,"index":index,"finished":finished,"last_id":kwargs['unique_id'],"mode":mode,"map_item":kwargs.get("map_item", False)}
+
+		if mode == "LOOP": #The Inputs of this iteration and the accumulator are only needed by its [Loop Close], so they are handed over through a handle instead of staying in the cached LOOP output
+			iteration = {key: kwargs.get(key, None) for key in LoopClose.slot_names + ("accumulator",)}
+			loop_status["iteration"] = self.payloads.put(kwargs.get("dynprompt"), iteration)
+
+		values = [kwargs.get('data',None), kwargs.get('aux',None)] + [kwargs.get("aux%d" % x, None) for x in range(2,self.max_slots+1)]
 
-		Vars = loop_status
-		for key, value in VYKOSX_STORAGE_DATA.items(): Vars[key] = value
-		for key, value in kwargs.items():
-			if key!="unique_id" or key!="original_id": Vars[key] = value
+		if mode == "BATCH": #Only pass on the items of the iterations that belong to this chunk
+
+			if step == 0:
+				raise Exception("Loops in BATCH mode require a non-zero Step!")
+
+			indices, chunk_index, chunk_finished = [index], index, finished
+
+			while not chunk_finished and len(indices) < batch_size:
+				chunk_index += step
+				chunk_finished = (( end - chunk_index ) <= 0) if step >= 0 else (( end - chunk_index ) >= 0)
+				indices.append(chunk_index)
+
+			loop_status.update({"batch_size":batch_size,"indices":indices})
+			total = loop_iterations(start, step, end)
+			values = [batch_slice(value, (index - start) // step, len(indices), total) for value in values]
+
+		Vars = expression_variables(loop_status, kwargs)
 
 		debug_print ("VARS=",Vars)
 
@@ -365,7 +465,7 @@ HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 
 			loop_status['condition_open'] = condition
 
-			return tuple( [loop_status] + [kwargs.get('data',None), kwargs.get('aux',None)] + [kwargs.get("aux%d" % x, None) for x in range(2,self.max_slots+1) ],) #debug_print ("LOOP RET=",ret)
+			return tuple( [loop_status] + values ) #debug_print ("LOOP RET=",ret)
 
 		else:
 
@@ -383,6 +483,7 @@ class LoopClose:
 		pass
 
 	max_slots = MAX_SLOTS+1
+	slot_names = tuple(["data","aux"] + ["aux%d" % i for i in range(2, max_slots-1)]) #Inputs carried between iterations. Output slot N of the [Loop Open] is slot_names[N-1]
 
 	@classmethod
 	def INPUT_TYPES(s):
@@ -394,6 +495,9 @@ class LoopClose:
 			"optional": {
 				"data": (any_type, {"forceInput": True, "tooltip": "Any data you wish to iterate on in the loop"}),
 				"aux": (any_type, {"forceInput": True, "tooltip": "Any auxilliary data you wish to iterate on in the loop"}),
+				"convergence": (["OFF","RELATIVE_L2","MAX_ABS"], {"default": "OFF", "tooltip": "Stop the loop once the Data tensor stops changing between iterations.\nRELATIVE_L2: Size of the change relative to the size of the previous Data\nMAX_ABS: Largest change of any single value"}),
+				"threshold": ("FLOAT", {"default": 0.001, "min": 0.0, "max": 0xffffffff, "step": 0.0001, "tooltip": "The loop stops once the change measured by Convergence is below this value"}),
+				"memoize": ("BOOLEAN", {"default": False, "tooltip": "Remember the results of every iteration, so that running the Loop again skips the iterations that were already computed with the same Data.\nOnly enable it if the nodes inside the Loop depend on nothing but the Data passed through the [Loop Open] node and their own settings"}),
 			},
 			"hidden": {
 				"dynprompt": "DYNPROMPT",
@@ -403,13 +507,15 @@ class LoopClose:
 
 		for i in range(2,s.max_slots-1): inputs["optional"]["aux%d" % i] = (any_type, {"forceInput": True, "tooltip": "Any auxilliary data you wish to iterate on in the loop"})
 
+		inputs["optional"]["accumulate"] = (any_type, {"forceInput": True, "tooltip": "Data to collect from every iteration of the loop. The results of all the iterations are returned together by the Accumulated output once the Loop finishes"})
+
 		return inputs
 
 	CATEGORY = MAIN_CATEGORY
 	FUNCTION = "loop"
-	RETURN_TYPES = tuple( ["BOOLEAN"]+[any_type for x in range(max_slots-1) ] )
-	RETURN_NAMES = tuple ( ["FINISHED?","data","aux"] + ["aux%d" % x for x in range(2, max_slots)] )
-	OUTPUT_TOOLTIPS = tuple ( [ "This output will return True when the Loop is done executing"] + ["Final values for any Data that has been processed by the Loop"] * max_slots)
+	RETURN_TYPES = tuple( ["BOOLEAN"]+[any_type for x in range(max_slots) ] )
+	RETURN_NAMES = tuple ( ["FINISHED?","data","aux"] + ["aux%d" % x for x in range(2, max_slots-1)] + ["accumulated"] )
+	OUTPUT_TOOLTIPS = tuple ( [ "This output will return True when the Loop is done executing"] + ["Final values for any Data that has been processed by the Loop"] * (max_slots-1) + ["Everything passed to the Accumulate input by every iteration, joined into a single batch for images, latents and other tensors of the same size, or a list for anything else"])
 	DESCRIPTION = \
 """Loops allow you to automate entire sections of your workflow by repeating the nodes connected to the Loop a specific number of times or until a specific condition no longer applies.
 
@@ -421,46 +527,139 @@ Once the Loop is done executing, the FINISHED? Output will return True. If Condi
 
 This node uses the new Execution Inversion mechanics and requires an updated version of ComfyUI. It works by dynamically cloning all the nodes that are connected as children of the [Loop Open] and [Loop Close] nodes, while forwarding the data to the copies on each iteration. This is still a bit of proof of concept, so issues may occur. Please report any bugs on the	 Issues page of this node pack's Github repo!
 
+The Data of each iteration is handed over to the next one without being stored in the prompt, but with its default cache ComfyUI still keeps the outputs of every node it ran (including the copies made for every iteration) until the prompt finishes, so long loops over images or latents still use more memory the more iterations they run. Starting ComfyUI with --cache-lru or --cache-none allows the outputs of finished iterations to be released.
+
+Loops that refine their Data (such as repeatedly denoising the same latent) can stop as soon as it settles by setting Convergence. After every iteration the Data tensor (or the samples of a latent) is compared to the one the iteration started with, and the loop finishes once the change is below Threshold.
+
+Long loops can remember the results of every iteration by enabling Memoize. If the prompt is queued again (for example after an error halfway through the Loop, or to change nodes that come after the Loop) the iterations that already ran with the same Data and settings are skipped. Results are kept in memory and moved to ComfyUI's temporary folder when they take too much space. Nodes inside the Loop that read anything other than the Data of the Loop (such as a prompt coming from outside the Loop) may be skipped even if that input has changed, so only enable it for self-contained Loops.
+
+To collect a result from every iteration (such as each image generated by the Loop) connect it to the Accumulate input instead of joining the batches yourself on every iteration. The results are copied once into a batch that is allocated for the expected number of iterations, and the whole batch is returned by the Accumulated output when the Loop finishes.
+
+Nodes inside the Loop that only depend on Data which is passed from the [Loop Open] Outputs straight back to the [Loop Close] Inputs unchanged (such as a fixed prompt being encoded) are not cloned, and their results from the first iteration are reused on every iteration instead.
+
 HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 """
 
+	loop_bodies = weakref.WeakKeyDictionary() #DynamicPrompt -> {loop id: loop body}. The body is found on the first iteration and reused by the rest
+	expansions = weakref.WeakKeyDictionary() #DynamicPrompt -> counter of the expansions created by Loops
+
+	def expansion_prefix(self, dynprompt):
+		"""
+		Get a short prefix for the ids of the nodes of a new expansion. The default prefix of a GraphBuilder starts with the id of the node
+		that expands, which is itself a copy on every iteration after the first, so ids would grow longer with each iteration.
+		Copies are always named after the nodes of the first iteration instead, so ids only grow with the nesting depth of the Loops.
+		"""
+		return "L%d." % next(self.expansions.setdefault(dynprompt, itertools.count(1)))
+
 	def find_subnodes(self, node_id, dynprompt, node_data):
-		node_info = dynprompt.get_node(node_id)
-		if "inputs" not in node_info:
-			return
-		for key, value in node_info["inputs"].items():
-			if is_link(value):
-				parent_id = value[0]
-				if parent_id not in node_data:
-					node_data[parent_id] = []
-					self.find_subnodes(parent_id, dynprompt, node_data)
-				node_data[parent_id].append(node_id)
+		stack = [node_id]
+		while stack:
+			node_id = stack.pop()
+			for key, value in dynprompt.get_node(node_id).get("inputs", {}).items():
+				if is_link(value):
+					parent_id = value[0]
+					if parent_id not in node_data:
+						node_data[parent_id] = []
+						stack.append(parent_id)
+					node_data[parent_id].append(node_id)
 
 	def get_subnodes(self, node_id, node_data, subnodes):
-		if node_id not in node_data:
-			return
-		for child_id in node_data[node_id]:
-			if child_id not in subnodes:
-				subnodes[child_id] = True
-				self.get_subnodes(child_id, node_data, subnodes)
+		stack = [node_id]
+		while stack:
+			for child_id in node_data.get(stack.pop(), ()):
+				if child_id not in subnodes:
+					subnodes[child_id] = True
+					stack.append(child_id)
+
+	def get_loop_body(self, dynprompt, open_node, close_node, loop_id, mode="LOOP"):
+		"""
+		Find the nodes between a Loop Open and a Loop Close along with their inputs, or reuse the ones found on the first iteration of the loop.
+		Links are flagged as internal when they point to another node of the body.
+		
+		:return: A dictionary with the "open" and "close" node ids of the first iteration, the body "nodes",
+		         node id -> (class_type, [(input name, value, internal link?)]), with the Loop Open and Loop Close included,
+		         and the set of "invariant" nodes whose outputs are the same on every iteration.
+		"""
+		bodies = self.loop_bodies.setdefault(dynprompt, {})
+
+		if (body := bodies.get(loop_id)) is not None:
+			return body
+
+		self.find_subnodes(close_node, dynprompt, node_data:={}) # Get list of all nodes connected to the loop
+		self.get_subnodes(open_node, node_data, subnodes:={}) #Find only the nodes that are within both Open and Close Loop
+
+		subnodes[close_node] = True; subnodes[open_node] = True
 
-	def loop(self, LOOP, condition, dynprompt=None, unique_id=None, **kwargs):
+		nodes = {}
+		for node_id in subnodes:
+			original_node = dynprompt.get_node(node_id)
+			nodes[node_id] = (original_node["class_type"], [(key, value, is_link(value) and value[0] in subnodes) for key, value in original_node["inputs"].items()])
+
+		if mode == "MAP": #Every iteration receives the same Data, only the LOOP output changes
+			invariant_slots = set(range(1, len(self.slot_names)+1))
+		elif mode == "BATCH": #Every chunk receives its own part of the Data
+			invariant_slots = set()
+		else: #Only the Data that the Loop Close receives straight from the matching Loop Open output stays the same
+			invariant_slots = {slot for slot, key in enumerate(self.slot_names, 1) for input_name, value, internal in nodes[close_node][1] if input_name == key and value == [open_node, slot]}
+
+		body = bodies[loop_id] = {"open": open_node, "close": close_node, "nodes": nodes, "invariant": self.find_invariant_nodes(nodes, open_node, close_node, invariant_slots)}
+
+		return body
+
+	def find_invariant_nodes(self, body_nodes, open_node, close_node, invariant_slots):
+		"""
+		Find the nodes of the loop body that don't depend on anything that changes between iterations.
+		Output nodes and nodes that define IS_CHANGED are always considered to change, since they are expected to run on every iteration.
+		
+		:param invariant_slots: The Loop Open output slots that have the same value on every iteration.
+		:return: A set with the ids of the invariant nodes.
+		"""
+		invariant, changed = set(), True
+
+		while changed:
+			changed = False
+			for node_id, (class_type, inputs) in body_nodes.items():
+				if node_id in invariant or node_id == open_node or node_id == close_node:
+					continue
+				node_class = nodes.NODE_CLASS_MAPPINGS.get(class_type)
+				if node_class is None or getattr(node_class, "OUTPUT_NODE", False) or hasattr(node_class, "IS_CHANGED"):
+					continue
+				if all(value[0] in invariant or value[0] == open_node and value[1] in invariant_slots for key, value, internal in inputs if internal):
+					invariant.add(node_id)
+					changed = True
+
+		return invariant
+
+	def loop(self, LOOP, condition, dynprompt=None, unique_id=None, convergence="OFF", threshold=0.001, memoize=False, **kwargs):
 
 		if condition=="": condition = True
 
 		debug_print ("\n>> LOOP [",LOOP.get('id',0),"] CLOSE")
 
-		Vars = LOOP; Vars['condition_close'] = condition
+		Vars = expression_variables({'condition_close': condition}, LOOP, kwargs)
 
-		for key, value in VYKOSX_STORAGE_DATA.items(): Vars[key] = value
-		for key, value in kwargs.items(): Vars[key] = value
-		
-		if LOOP['finished'] or not safe_eval(condition,Vars):
+		if LOOP.get('mode') in ("MAP", "BATCH"):
+			return self.map_loop(LOOP, condition, Vars, dynprompt, unique_id, kwargs)
+
+		#The Inputs the [Loop Open] started this iteration with, missing if its output was cached by an earlier prompt
+		iteration = LoopOpen.payloads.take(dynprompt, LOOP['iteration'], required=False) if LOOP.get('iteration') is not None else None
+
+		accumulator = iteration.get('accumulator') if iteration is not None else None
+
+		if kwargs.get('accumulate') is not None: #The accumulator is created by the first iteration and passed on to the next ones by the [Loop Open]
+			if accumulator is None: accumulator = LoopAccumulator(self.count_iterations(LOOP))
+			accumulator.append(kwargs['accumulate'])
+
+		index, carried = LOOP['index'], {key: kwargs.get(key, None) for key in self.slot_names}
+
+		stop = LOOP['finished'] or not safe_eval(condition,Vars) or iteration is not None and self.converged(iteration.get('data'), kwargs.get('data'), convergence, threshold)
 
-			values = [True, kwargs.get('data',None) , kwargs.get('aux',None)]
+		if memoize and iteration is not None:
+			index, carried, stop, accumulator = self.replay_iterations(LOOP, iteration, dynprompt, unique_id, carried, kwargs.get('accumulate'), stop, accumulator)
 
-			for i in range(2, self.max_slots):
-				values.append(kwargs.get("aux%d" % i, None))
+		if stop:
+
+			values = [True] + [carried[key] for key in self.slot_names] + [accumulator.result() if accumulator is not None else None]
 
 			debug_print ("\nLOOP [",LOOP.get('id',0),"] FINISHED!")
 
@@ -468,52 +667,254 @@ HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 
 		else:
 
-			this_node = dynprompt.get_node(unique_id)
+			if GraphBuilder is None:
+				raise Exception("Unable to create Loop system, this ComfyUI version is too old to support it.\nPlease update your ComfyUI to be able to utilize Loops!")
 
-			self.find_subnodes(unique_id, dynprompt, node_data:={}) # Get list of all nodes connected to the loop
-			self.get_subnodes(open_node:=LOOP['last_id'], node_data, subnodes:={}) #Find only the nodes that are within both Open and Close Loop
+			#Every iteration is rebuilt from the nodes of the first one, so the loop body only has to be found once
+			body = self.get_loop_body(dynprompt, LOOP['last_id'], unique_id, LOOP['id'])
+			close_node, open_node = body["close"], body["open"]
 
-			subnodes[unique_id] = True; subnodes[open_node] = True
+			graph = GraphBuilder(self.expansion_prefix(dynprompt))
 
-			graph = GraphBuilder()
+			#Nodes that don't depend on the loop are not cloned, their outputs from the first iteration are reused instead
+			invariant = body["invariant"]
 
-			if graph is None:
-				raise Exception("Unable to create Loop system, this ComfyUI version is too old to support it.\nPlease update your ComfyUI to be able to utilize Loops!")
+			for node_id, (class_type, inputs) in body["nodes"].items():
 
-			for node_id in subnodes:
+				if node_id in invariant: continue
 
-				original_node = dynprompt.get_node(node_id)
-				node = graph.node(original_node["class_type"], "R" if node_id == unique_id else node_id)
+				node = graph.node(class_type, node_id)
 
 				node.set_override_display_id(node_id)
 
-			for node_id in subnodes: #Iterate over each of our subnodes
+			for node_id, (class_type, inputs) in body["nodes"].items(): #Iterate over each of our subnodes
+
+				if node_id in invariant: continue
 
-				original_node = dynprompt.get_node(node_id)
-				node = graph.lookup_node("R" if node_id == unique_id else node_id)
+				node = graph.lookup_node(node_id)
 
-				for key, value in original_node["inputs"].items(): #Recreate the inputs for all the subnodes
+				for key, value, internal in inputs: #Recreate the inputs for all the subnodes
 
-					if is_link(value) and value[0] in subnodes:
+					if internal and value[0] not in invariant:
 						parent = graph.lookup_node(value[0])
 						node.set_input(key, parent.out(value[1]))
 					else:
 						node.set_input(key, value)
 
-			#Recreate the inputs of our new Loop Open node
+			#Recreate the inputs of our new Loop Open node. The Data is handed over through a handle so that the prompt doesn't keep it alive after the next iteration starts
 			new_open = graph.lookup_node(open_node)
-			new_open.set_input("data", kwargs.get("data", None))
-			new_open.set_input("aux", kwargs.get("aux", None))
-			new_open.set_input("index_override", LOOP['index']+LOOP['step'] )
+			new_open.set_input("index_override", index+LOOP['step'] )
 			new_open.set_input("original_id", LOOP['id'] )
 
-			for i in range(2, self.max_slots-1): new_open.set_input(key:="aux%d" % i, kwargs.get(key, None))
+			for key in self.slot_names: new_open.set_input(key, None)
 
-			new_subnode_graph = graph.lookup_node("R")
-			result = [ new_subnode_graph.out(x) for x in range(self.max_slots) ] #result = map(lambda x: new_subnode_graph.out(x), range(self.max_slots))
+			carried = {**carried, "accumulator": accumulator}
+
+			new_open.set_input("carried", LoopOpen.payloads.put(dynprompt, carried))
+
+			new_subnode_graph = graph.lookup_node(close_node)
+			result = [ new_subnode_graph.out(x) for x in range(len(self.RETURN_TYPES)) ] #result = map(lambda x: new_subnode_graph.out(x), range(self.max_slots))
 
 			return { "result": tuple(result), "expand": graph.finalize(), }
 
+	iteration_memo = None #Created the first time a Loop is memoized
+
+	def replay_iterations(self, LOOP, iteration, dynprompt, unique_id, carried, accumulate, stop, accumulator):
+		"""
+		Memoize the iteration that just finished, then skip the following iterations whose results are already memoized.
+		Iterations are identified by the id and nodes of the Loop, their index and a fingerprint of the Data they start with.
+		
+		:return: The index, Data, stop flag and accumulator of the last iteration that has been completed.
+		"""
+		if LoopClose.iteration_memo is None:
+			LoopClose.iteration_memo = IterationMemo(os.path.join(folder_paths.get_temp_directory(), "loop_iterations"))
+
+		memo = LoopClose.iteration_memo
+
+		body = self.get_loop_body(dynprompt, LOOP['last_id'], unique_id, LOOP['id'])
+
+		if "signature" not in body:
+			body["signature"] = content_fingerprint((LOOP['id'], body["nodes"]))
+
+		index, step = LOOP['index'], LOOP['step']
+		key = "%s:%s:%s" % (body["signature"], index, content_fingerprint({key: iteration.get(key) for key in self.slot_names}))
+
+		memo.put(key, {"data": carried, "accumulate": accumulate, "stop": stop})
+
+		seen = {key}
+
+		while not stop:
+
+			key = "%s:%s:%s" % (body["signature"], index+step, content_fingerprint(carried))
+
+			if key in seen or (entry := memo.get(key)) is None: #Stop at the first iteration that hasn't run yet, or if the Loop would repeat itself
+				break
+
+			seen.add(key)
+			index, carried, stop = index+step, entry["data"], entry["stop"]
+
+			if entry["accumulate"] is not None:
+				if accumulator is None: accumulator = LoopAccumulator(self.count_iterations(LOOP))
+				accumulator.append(entry["accumulate"])
+
+		if len(seen) > 1:
+			debug_print ("LOOP [",LOOP.get('id',0),"] SKIPPED",len(seen)-1,"MEMOIZED ITERATIONS")
+
+		return index, carried, stop, accumulator
+
+	def converged(self, previous, current, metric, threshold):
+		"""
+		Check whether the Data of the Loop changed less than threshold during the last iteration.
+		The change is measured on the device of the Data, only the final value is transferred.
+		"""
+		if metric == "OFF":
+			return False
+
+		previous, current = [value["samples"] if isinstance(value, dict) and "samples" in value else value for value in (previous, current)]
+
+		if not isinstance(previous, torch.Tensor) or not isinstance(current, torch.Tensor) or previous.shape != current.shape or current.numel() == 0:
+			return False
+
+		difference = current.float() - previous.float()
+
+		if metric == "MAX_ABS":
+			delta = difference.abs().max()
+		else:
+			delta = torch.linalg.vector_norm(difference) / torch.linalg.vector_norm(previous.float()).clamp_min(1e-12)
+
+		delta = delta.item()
+
+		debug_print ("LOOP CONVERGENCE", metric, "=", delta)
+
+		return delta < threshold
+
+	def count_iterations(self, LOOP):
+		"""
+		Estimate how many iterations a Loop will run from its Start, Step and End, or None for While Loops.
+		"""
+		return loop_iterations(LOOP['start'], LOOP['step'], LOOP['end'])
+
+	def map_loop(self, LOOP, condition, Vars, dynprompt, unique_id, kwargs):
+		"""
+		Run a Loop in MAP mode. The first [Loop Close] creates every remaining iteration in a single expansion, each with its own
+		copy of the loop body starting from the original Inputs of the [Loop Open], and gathers the Outputs of all of them.
+		The copies of the [Loop Close] only return the Data of their own iteration, or nothing if their Condition is not True.
+		In BATCH mode each copy runs a whole chunk of iterations, so only the first index of every chunk gets a copy.
+		"""
+		include = safe_eval(condition,Vars)
+		gathered = self.slot_names + ("accumulate",)
+		values = [kwargs.get(key, None) for key in gathered]
+
+		if LOOP.get('map_item'):
+			return tuple( [True] + (values if include else [None] * len(values)) )
+
+		if GraphBuilder is None:
+			raise Exception("Unable to create Loop system, this ComfyUI version is too old to support it.\nPlease update your ComfyUI to be able to utilize Loops!")
+
+		index, step, end, finished, indices = LOOP['index'], LOOP['step'], LOOP['end'], LOOP['finished'], []
+
+		if step == 0 and not finished:
+			raise Exception("Loops in %s mode require a non-zero Step!" % LOOP['mode'])
+
+		while not finished:
+			index += step
+			finished = (( end - index ) <= 0) if step >= 0 else (( end - index ) >= 0)
+			indices.append(index)
+
+		debug_print ("\n>> LOOP [",LOOP['id'],"] MAPPING",len(indices)+1,"ITERATIONS")
+
+		if LOOP['mode'] == "BATCH": #The first chunk already covered batch_size iterations
+			indices = indices[LOOP['batch_size']-1::LOOP['batch_size']]
+
+		body = self.get_loop_body(dynprompt, LOOP['last_id'], unique_id, LOOP['id'], mode=LOOP['mode'])
+		close_node, open_node, invariant = body["close"], body["open"], body["invariant"]
+
+		graph = GraphBuilder(self.expansion_prefix(dynprompt))
+		gather = graph.node("LoopGather", "gather")
+
+		if include: #The first iteration has already run, gather the Inputs this node received
+			for key, value, internal in body["nodes"][close_node][1]:
+				if key in gathered:
+					gather.set_input("%d_0" % gathered.index(key), value)
+
+		for n, index in enumerate(indices, 1):
+
+			for node_id, (class_type, inputs) in body["nodes"].items():
+
+				if node_id in invariant: continue
+
+				node = graph.node(class_type, "%d.%s" % (n, node_id))
+
+				node.set_override_display_id(node_id)
+
+			for node_id, (class_type, inputs) in body["nodes"].items():
+
+				if node_id in invariant: continue
+
+				node = graph.lookup_node("%d.%s" % (n, node_id))
+
+				for key, value, internal in inputs:
+
+					if internal and value[0] not in invariant:
+						node.set_input(key, graph.lookup_node("%d.%s" % (n, value[0])).out(value[1]))
+					else:
+						node.set_input(key, value)
+
+			item_open = graph.lookup_node("%d.%s" % (n, open_node))
+			item_open.set_input("index_override", index)
+			item_open.set_input("original_id", LOOP['id'])
+			item_open.set_input("map_item", True)
+
+			item_close = graph.lookup_node("%d.%s" % (n, close_node))
+
+			for slot in range(len(gathered)):
+				gather.set_input("%d_%d" % (slot, n), item_close.out(slot+1))
+
+		return { "result": tuple( [True] + [gather.out(slot) for slot in range(len(gathered))] ), "expand": graph.finalize(), }
+
+class LoopGather:
+
+	max_slots = MAX_SLOTS+1
+
+	@classmethod
+	def INPUT_TYPES(s):
+		return { "required": {}, } #Inputs are named "<slot>_<iteration>" and are created dynamically by the [Loop Close] node
+
+	CATEGORY = MAIN_CATEGORY
+	FUNCTION = "gather"
+	RETURN_TYPES = tuple( [any_type for x in range(max_slots)] )
+	RETURN_NAMES = tuple( ["data","aux"] + ["aux%d" % x for x in range(2, max_slots-1)] + ["accumulated"] )
+	OUTPUT_TOOLTIPS = tuple( ["Results of every iteration of the Loop gathered together"] * max_slots )
+	DESCRIPTION = \
+"""Internal node used by Loops in MAP mode to collect the results of all their iterations. It is created automatically by the [Loop Close] node and you don't need to add it to your workflows yourself.
+
+Tensors of the same size (such as images or masks) and latents are joined into a single batch, any other kind of Data is returned as a list with the value of every iteration. Missing values are skipped.
+"""
+	def gather(self, **kwargs):
+
+		slots = [[] for x in range(self.max_slots)]
+
+		for key, value in sorted(kwargs.items(), key=lambda item: tuple(map(int, item[0].split("_")))):
+			if value is not None:
+				slots[int(key.split("_")[0])].append(value)
+
+		return tuple( self.join(items) for items in slots )
+
+	def join(self, items):
+
+		if not items:
+			return None
+
+		if all(isinstance(item, torch.Tensor) and item.dim() > 0 for item in items) and len({tuple(item.shape[1:]) for item in items}) == 1:
+			return torch.cat(items, 0)
+
+		if all(isinstance(item, dict) and isinstance(item.get("samples"), torch.Tensor) for item in items):
+			samples = self.join([item["samples"] for item in items])
+			if isinstance(samples, torch.Tensor):
+				return {**items[0], "samples": samples} #Other keys such as noise masks only apply to a single latent, so only the first one is kept
+
+		return list(items)
+
 class UniversalSwitch:
 
 	#TODO: Make input and output amounts dynamic and have a working setting for type validation.
@@ -703,6 +1104,9 @@ HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 
 class IfConditionSelector:
 
+	def __init__(self):
+		self.lazy_state = {}
+
 	@classmethod
 	def INPUT_TYPES(s):
 		return {
@@ -738,7 +1142,7 @@ class IfConditionSelector:
 				"B": (any_type, {"forceInput": True, "lazy": True,"tooltip": "Second Input to Evaluate"}),
 				"TRUE_IN": (any_type, {"forceInput": True, "lazy": True, "tooltip": "Input to forward if the expression evaluates to True"}),
 				"FALSE_IN": (any_type, {"forceInput": True, "lazy": True, "tooltip": "Input to forward if the expression evaluates to False"}),
-			}, "hidden": { "unique_id": "UNIQUE_ID" } #"comparison_type": (["Values","Length(A)|Value(B)","Length (Both)","Address(A)|Value (B)","Address (Both)"],),
+			}, "hidden": { "unique_id": "UNIQUE_ID", "prompt": "PROMPT", "dynprompt": "DYNPROMPT", "evaluated": "STRING" } #"comparison_type": (["Values","Length(A)|Value(B)","Length (Both)","Address(A)|Value (B)","Address (Both)"],),
 
 	   }
 
@@ -760,9 +1164,11 @@ If Require_Inputs is enabled, then you must specify the TRUE_IN and FALSE_IN inp
 
 If Condition is set to CUSTOM, you may further specify a custom expression which will be evaluated. Within this expression you may use the variables A and B to refer to those respective inputs as well as any named global variables from [Memory Storage] nodes. Most valid Python expressions, types and built-in functions are supported in the custom expression. For a full list of supported operations please consult the file 'Helper.py' included in this node pack.
 
+Custom expressions request their inputs one at a time, in the order the expression reads them. With an expression such as "A is None or B > 3", B will only be executed if A is not None, so cheap checks placed first can prevent expensive branches from running at all.
+
 HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 """
-	def compare(self,A,B,condition,NOT,custom_expression=""):
+	def compare(self,A,B,condition,NOT,custom_expression="",pending=None):
 
 		global VYKOSX_STORAGE_DATA
 
@@ -819,12 +1225,14 @@ HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 		if condition == "CUSTOM":
 			if custom_expression!="":
 
-				Vars = {"A":A,"a":A,"B":B,"b":B}
+				Inputs = {"A":A,"a":A,"B":B,"b":B}
+
+				if pending:
+					for key in pending: Inputs.pop(key,None)
 
-				for key, value in VYKOSX_STORAGE_DATA.items():
-					Vars[key] = value
+				Vars = expression_variables(Inputs, hidden=pending or ())
 
-				ret = safe_eval(custom_expression,Vars) #return cbool( ast.literal_eval(B) )
+				ret = safe_eval(custom_expression,Vars,pending=pending) #return cbool( ast.literal_eval(B) )
 
 		if NOT:
 
@@ -835,34 +1243,115 @@ HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 
 		return ret
 
-	def check_lazy_status(s,condition,require_inputs,NOT,custom_expression,A=None,B=None,TRUE_IN=None,FALSE_IN=None,unique_id=0):
+	def check_lazy_status(s,condition,require_inputs,NOT,custom_expression,A=None,B=None,TRUE_IN=None,FALSE_IN=None,unique_id=0,prompt=None,dynprompt=None,evaluated=""):
 
 		debug_print (">> IF LAZY CHECK! A:",A,"B:",B,"cond:",condition,"NOT:",NOT,"TRUE:",TRUE_IN,"FALSE:",FALSE_IN)
 
 		lazy = []
 
-		if condition == "CUSTOM":
-			if "a" in custom_expression.casefold(): lazy+=["A"]
-			if "b" in custom_expression.casefold(): lazy+=["B"]
+		state = s.lazy_state.get(unique_id)
+
+		if state is None or state['prompt'] is not prompt:
+			#Inputs listed in 'evaluated' were already requested by the node this one was copied from, see run_comparison
+			state = s.lazy_state[unique_id] = {'prompt': prompt, 'requested': set(filter(None, evaluated.split(","))), 'stage': None, 'result': None}
+
+		memo = state['result'] #ComfyUI checks again once the requested branch has run, reuse the result if the inputs are the same
+		cached = memo is not None and memo[0] is A and memo[1] is B and memo[2:5] == (condition,NOT,custom_expression)
+
+		if cached:
+
+			debug_print (">> REUSING RESULT FROM PREVIOUS LAZY CHECK")
+			ret = memo[5]
+
+			if condition != "CUSTOM":
+				if "A" in condition: lazy+=["A"]
+				if "B" in condition: lazy+=["B"]
+
+		elif condition == "CUSTOM":
+
+			try:
+				names = expression_names(custom_expression)
+			except Exception as x:
+				debug_print ("[!] UNABLE TO PARSE CUSTOM EXPRESSION:",x,". REQUESTING ALL INPUTS.")
+				return ["A","B"]
+
+			#Inputs are requested one stage at a time. Any referenced input that is still None and hasn't been requested yet
+			#is treated as pending, and the expression is evaluated with short-circuiting until it actually needs one of them.
+			#Whether an input was evaluated is tracked in the state rather than by its value, since an input can evaluate to None.
+
+			pending = set()
+
+			for key,value in (("A",A),("B",B)):
+				if names & {key,key.lower()} and value is None and key not in state['requested']:
+					pending |= {key,key.lower()}
+
+			try:
+				ret = s.compare(A,B,condition,NOT,custom_expression,pending)
+
+			except PendingInputError as x:
+
+				key = x.name.upper()
+				state['requested'].add(key)
+				state['stage'] = key
+
+				debug_print (">> LAZY STAGE REQUESTED:",key)
+
+				return [key]
+
 		else:
+
 			if "A" in condition: lazy+=["A"]
 			if "B" in condition: lazy+=["B"]
 
-		if require_inputs:
+			if require_inputs:
+				ret = s.compare(A,B,condition,NOT,custom_expression)
 
-			ret = s.compare(A,B,condition,NOT,custom_expression)
+		state['stage'] = None
 
+		if require_inputs:
 			lazy += ["TRUE_IN"] if ret else ["FALSE_IN"]
 
+		if not cached and (condition == "CUSTOM" or require_inputs):
+			state['result'] = (A,B,condition,NOT,custom_expression,ret) #Remembered so the condition isn't evaluated again by run_comparison or later checks
+
 		debug_print (">> LAZY RESULT:",lazy)
 
 		return lazy
 
-	def run_comparison(s,condition,require_inputs,NOT,custom_expression,A=None,B=None,TRUE_IN=None,FALSE_IN=None,unique_id=0):
+	def run_comparison(s,condition,require_inputs,NOT,custom_expression,A=None,B=None,TRUE_IN=None,FALSE_IN=None,unique_id=0,prompt=None,dynprompt=None,evaluated=""):
+
+		state = s.lazy_state.pop(unique_id,None)
 
 		debug_print ("\n>> IF CONDITION [",unique_id,"]\n>> COMPARE! A:",A,"B:",B,"cond:",condition,"CUSTOM:",custom_expression,"NOT:",NOT,"TRUE:",TRUE_IN,"FALSE:",FALSE_IN)
 
-		ret = s.compare(A,B,condition,NOT,custom_expression)
+		if state is not None and state['prompt'] is prompt and state['stage'] is not None and GraphBuilder is not None and dynprompt is not None:
+
+			#ComfyUI only checks the lazy status again if a requested input still had to be executed. When the requested input was
+			#already evaluated (e.g. a cached None) the node runs straight away, before the remaining inputs of the expression have
+			#been requested. Hand over to a copy of this node that knows which inputs were evaluated so it can request the rest.
+
+			debug_print (">> LAZY STAGE",state['stage'],"WAS ALREADY EVALUATED, CONTINUING IN A COPY OF THE NODE")
+
+			node = dynprompt.get_node(unique_id)
+
+			graph = GraphBuilder()
+			copy = graph.node(node["class_type"])
+
+			for key, value in node["inputs"].items():
+				copy.set_input(key, value)
+
+			copy.set_input("evaluated", ",".join(sorted(state['requested'])))
+			copy.set_override_display_id(unique_id)
+
+			return { "result": (copy.out(0),), "expand": graph.finalize(), }
+
+		memo = state['result'] if state is not None and state['prompt'] is prompt else None
+
+		if memo is not None and memo[0] is A and memo[1] is B and memo[2:5] == (condition,NOT,custom_expression):
+			debug_print (">> REUSING RESULT FROM LAZY CHECK")
+			ret = memo[5]
+		else:
+			ret = s.compare(A,B,condition,NOT,custom_expression)
 
 		debug_print (">> COMPARE RESULT:",ret)
 
@@ -1247,7 +1736,7 @@ class DataMonitor:
 		return {
 			"required": {
 				"text":("STRING", {"default": '',"multiline": True,"defaultInput": False,"print_to_screen": True}),
-				"output_type": (["ANY","STRING","INT","FLOAT","BOOLEAN","LIST","TUPLE","DICT","JSON","FORMULA"],{"tooltip":"The type the Passthrough or Text should be converted to"}),
+				"output_type": (["ANY","STRING","INT","FLOAT","BOOLEAN","LIST","TUPLE","DICT","JSON","FORMULA","FORMULA_BATCH","FORMULA_ISOLATED"],{"tooltip":"The type the Passthrough or Text should be converted to"}),
 			},
 				"optional": {
 					"passthrough":(any_type, {"default": "","multiline": True,"forceInput": True,"tooltip": "Any value or data to be visualized and forwarded by this node"}),
@@ -1282,6 +1771,8 @@ Output_Type can have any of the following values:
 • DICT: The Passthrough/Text will be converted into a Dictionary before being forwarded. You must specify your expressions in "Key1:Value1,Key2:Value2…" format.
 • JSON: The Passthrough/Text will be loaded as a JSON dictionary. It must be valid JSON or the function will fail.
 • FORMULA: The Passthrough/Text will be evaluated as Python expression, with full support for most common operators, data types and built-in functions. Internally this is implemented through a restricted subset of the Python language to prevent arbitrary code execution. You can see the full list of support operations and functions in the included 'Helpers.py' file. This output mode allows you to perform complex mathematical and logical operations, including conditionals, loops, lambda functions, list comprehensions, return fully defined arbitrary data types and much, much more.
+• FORMULA_BATCH: The Text will be evaluated as a FORMULA once for every set of variables received through Passthrough (or through Aux if Passthrough is missing) and a list with all the results will be returned. The variables can be either a list of dictionaries or a dictionary of equally sized lists, e.g. {"width": [512, 768], "height": [768, 512]}. Purely numerical formulas are calculated for all the entries at once, which is much faster than evaluating them one by one.
+• FORMULA_ISOLATED: Same as FORMULA, but the formula is evaluated in a separate worker process. Use it for heavy calculations (such as generating and scoring large numbers of prompt combinations) so ComfyUI stays responsive while they run. If the formula takes longer than a minute its worker is terminated and an error is raised instead of stalling the server.
 
 This node further supports Dynamic Variable Notation which will replace the entries for the following variables:
 • %AUX%,%AUX2-5%: Replaces the placeholder %AUX%, %AUX2%,%AUX3%,%AUX4% and %AUX5% with the values of the respective Aux Inputs (Not Case Sensitive).
@@ -1291,6 +1782,7 @@ This node further supports Dynamic Variable Notation which will replace the entr
 • __MEM__STORAGE__GET__: Replaces the placeholder __MEM__STORAGE__GET__ with a dictionary of all currently saved Memory Storage entries and their outputs. You can use this to be able to query and manipulate all saved Memory Storages directly (Case Sensitive).
 • __MEM__STORAGE__SET__: Force replaces the internal Memory Storage dictionary with a new dictionary specified by the Aux input, allowing you to overwrite all saved Memory Storages directly. __MEM__STORAGE__SET__ will then be removed from the output after the operation is completed (Case Sensitive).
 • __MEM__STORAGE__CLEAR__: Deletes ALL current memory storages from Memory. Equivalent to __MEM__STORAGE__SET__ with an empty dictionary {} in the Auxiliary parameter. Use with caution. (Case Sensitive).
+• __EVAL__STATS__: Replaces the placeholder with a table of how many times each formula and condition in the workflow was evaluated and how long it took, slowest first. Requires EVAL_PROFILING to be enabled in 'Helpers.py'. The same report is available as JSON from the /vykosx/eval_stats server route (Case Sensitive).
 • =>__AUX__DISPLAY__PREFIX__: If this string is found inside the Auxiliary parameter, any text preceding this tag in the Auxiliary parameter will be prepended to the final output of the processing, effectively allowing Aux to be used to display additional information in conjunction with Passthrough.
 • __AUX__DISPLAY__SUFFIX__=>: If this string is found inside the Auxiliary parameter, any text following this tag in the Auxiliary parameter will be appended to the final output of the processing, effectively allowing Aux to be used to display additional information in conjunction with Passthrough.
 
@@ -1344,6 +1836,10 @@ HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 
 						ret = ret.replace("__MEM__STORAGE__KEYS__", ", ".join([k for k in VYKOSX_STORAGE_DATA]) )
 
+				if "__EVAL__STATS__" in ret:
+
+						ret = ret.replace("__EVAL__STATS__", format_eval_stats())
+
 			if aux_list is not None:
 
 				for i,aux in enumerate(aux_list):
@@ -1445,7 +1941,7 @@ HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 
 		if (passthrough is not None):
 
-			encapsulate = False
+			encapsulate,expression = False,text
 
 			try:
 				iterator = iter(passthrough)
@@ -1508,6 +2004,11 @@ HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 					else:
 						debug_print ("PASSTHROUGH FORMULA NUMERIC!")
 						encapsulate = True
+				case "FORMULA_BATCH":
+					text = safe_eval_many(str(expression),passthrough)
+				case "FORMULA_ISOLATED":
+					if text != "":
+						text = safe_eval_pooled(str(text))
 				case _:
 					text = passthrough
 
@@ -1546,6 +2047,14 @@ HOVER OVER THE INPUTS AND OUTPUTS FOR MORE INFO.
 				case "FORMULA":
 					if text != "":
 						text = safe_eval(str(text))
+				case "FORMULA_BATCH":
+					if text != "":
+						if not isinstance(aux, (list, tuple, dict)):
+							raise Exception("FORMULA_BATCH requires a list of dictionaries or a dictionary of lists in the Aux input when Passthrough is not connected!")
+						text = safe_eval_many(str(text),aux)
+				case "FORMULA_ISOLATED":
+					if text != "":
+						text = safe_eval_pooled(str(text))
 
 			debug_print ("RETURN [TEXT]:",text)
 
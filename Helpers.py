@@ -4,16 +4,44 @@ import math
 import random
 import fnmatch
 import os
+import functools
+import itertools
+import hashlib
+import json
+import copy
+import time
+import sys
+import weakref
+import pickle
+import io
+import inspect
+import struct
+import queue
+import threading
+import subprocess
+import concurrent.futures
+from collections import OrderedDict, deque
 import torch
 #from torch import *  # Import PyTorch
 
+try:
+	import safetensors.torch
+except ImportError:
+	safetensors = None
+
 DEBUG_MODE = True #Enable this flag to get all sorts of useful debug information in the console from most of the nodes in this pack.
+ITERATION_MEMO_MAX_BYTES = 2 * 1024**3 #Amount of memory the memoized results of Loop iterations may take before they are spilled to disk
+ACCUMULATOR_PREALLOCATE_BYTES = 256 * 1024**2 #Largest buffer the Loop accumulator reserves upfront for the expected iterations, it grows by doubling beyond that
 
 # HELPER FUNCTIONS
 #******************	
 def filter_node_id(node_id):
 	x = str(node_id).find(".")
-	return node_id if x == -1 else node_id[:x]
+	if x == -1:
+		return node_id
+	if node_id[0] == "L" and node_id[1:x].isdigit(): #Nodes created by Loops end with the id of the node they are a copy of
+		return node_id.rsplit(".", 1)[-1]
+	return node_id[:x]
 
 def pack_tuple(prefix_type, general_type, count):
 	return tuple([prefix_type] + [general_type for x in range(0,count)])
@@ -79,6 +107,259 @@ def is_list(x):
 	
 	except TypeError:
 		return False
+
+def loop_iterations(start, step, end):
+	"""
+	Count the iterations of a Loop from its Start, Step and End, or None for While Loops.
+	"""
+	if step == 0:
+		return None
+
+	return max(0, math.ceil((end - start) / step)) + 1
+
+def batch_slice(value, start, count, total):
+	"""
+	Take the items start to start+count along the batch dimension of a tensor, or of the "samples" tensor of a latent,
+	if it has exactly one item for each of the total iterations. Any other value (a single reference image or mask,
+	conditioning, a batch of a different size) is returned unchanged, since it is shared by every chunk.
+	"""
+	latent = isinstance(value, dict) and isinstance(value.get("samples"), torch.Tensor)
+	tensor = value["samples"] if latent else value
+
+	if not isinstance(tensor, torch.Tensor) or tensor.dim() == 0 or tensor.shape[0] != total:
+		return value
+
+	return {**value, "samples": tensor[start:start+count]} if latent else tensor[start:start+count]
+
+class LoopAccumulator:
+	"""
+	Collects the results of every iteration of a Loop into a single batch that is only built once, when the Loop finishes.
+	Tensors (and the samples of latents) are copied into a preallocated buffer sized for the expected number of iterations,
+	which doubles in size whenever it runs out of space. Anything else, or tensors that can't share a batch, is kept in a list.
+	"""
+	def __init__(self, expected=None):
+		self.expected = expected #Number of iterations the buffer is first allocated for
+		self.buffer = None
+		self.size = 0
+		self.offsets = [] #Where the result of each iteration starts in the buffer
+		self.latent = None #The first latent collected, used as a template for the final one
+		self.items = None #Used instead of the buffer once a result can't be batched
+
+	def append(self, value):
+
+		if self.items is None:
+
+			latent = isinstance(value, dict) and isinstance(value.get("samples"), torch.Tensor)
+			tensor = value["samples"] if latent else value
+
+			if isinstance(tensor, torch.Tensor) and tensor.dim() > 0 and self.batchable(tensor, latent):
+				if latent and self.latent is None: self.latent = value
+				self.write(tensor)
+				return
+
+			self.items = self.unbatch()
+
+		self.items.append(value)
+
+	def batchable(self, tensor, latent):
+
+		if self.buffer is None:
+			return True
+
+		return (self.latent is not None) == latent and tuple(tensor.shape[1:]) == tuple(self.buffer.shape[1:]) and tensor.dtype == self.buffer.dtype and tensor.device == self.buffer.device
+
+	def write(self, tensor):
+
+		count = tensor.shape[0]
+
+		if self.buffer is None:
+			row_bytes = max(tensor.numel() // max(count, 1) * tensor.element_size(), 1)
+			rows = min(count * max(self.expected or 1, 1), max(ACCUMULATOR_PREALLOCATE_BYTES // row_bytes, count))
+			self.buffer = torch.empty((rows,) + tuple(tensor.shape[1:]), dtype=tensor.dtype, device=tensor.device)
+		elif self.size + count > self.buffer.shape[0]:
+			buffer = torch.empty((max(self.buffer.shape[0] * 2, self.size + count),) + tuple(tensor.shape[1:]), dtype=tensor.dtype, device=tensor.device)
+			buffer[:self.size] = self.buffer[:self.size]
+			self.buffer = buffer
+
+		self.buffer[self.size:self.size+count] = tensor
+		self.offsets.append(self.size)
+		self.size += count
+
+	def unbatch(self):
+
+		items = []
+
+		for start, end in zip(self.offsets, self.offsets[1:] + [self.size]):
+			items.append({**self.latent, "samples": self.buffer[start:end]} if self.latent is not None else self.buffer[start:end])
+
+		self.buffer, self.size, self.offsets = None, 0, []
+
+		return items
+
+	def __len__(self):
+		return len(self.items) if self.items is not None else len(self.offsets)
+
+	def result(self):
+
+		if self.items is not None:
+			return self.items
+
+		if self.buffer is None:
+			return None
+
+		return {**self.latent, "samples": self.buffer[:self.size]} if self.latent is not None else self.buffer[:self.size]
+
+class PayloadRegistry:
+	"""
+	Hands values from one node to another through a small integer handle instead of embedding them in the prompt of an expansion,
+	where they would stay referenced until the whole prompt finishes. A value is released as soon as it is taken,
+	or when the prompt that owns it is discarded. This only keeps the prompt from holding on to the values: the outputs
+	of the nodes that received them stay in ComfyUI's cache for as long as the cache keeps them.
+	"""
+	def __init__(self):
+		self.payloads = weakref.WeakKeyDictionary() #Owner (usually a DynamicPrompt) -> {handle: value}
+		self.handles = itertools.count(1)
+		self.lock = threading.Lock()
+
+	def put(self, owner, value):
+
+		with self.lock:
+			handle = next(self.handles)
+			self.payloads.setdefault(owner, {})[handle] = value
+
+		return handle
+
+	def take(self, owner, handle, required=True):
+
+		with self.lock:
+			payloads = self.payloads.get(owner, {})
+			if handle not in payloads:
+				if not required:
+					return None
+				raise Exception("Data %s is no longer available, it has already been consumed or its prompt has finished executing!" % handle)
+			return payloads.pop(handle)
+
+	def __len__(self):
+		return sum(len(payloads) for payloads in self.payloads.values())
+
+def content_fingerprint(value, digest=None):
+	"""
+	Build a digest of a value from its contents, so that equal values get the same fingerprint across different prompts.
+	Tensors are hashed from their data, which is copied to the CPU first. Objects that aren't plain data (such as models)
+	are identified by type and object id, so they only match while the same object is alive.
+	
+	:return: The fingerprint as a hex string.
+	"""
+	top = digest is None
+	if top: digest = hashlib.blake2b(digest_size=16)
+
+	kind = type(value)
+
+	if isinstance(value, torch.Tensor):
+		tensor = value.detach()
+		digest.update(repr(("tensor", str(tensor.dtype), tuple(tensor.shape))).encode())
+		if tensor.numel():
+			digest.update(tensor.contiguous().view(-1).view(torch.uint8).cpu().numpy())
+	elif value is None or kind in (bool, int, float, complex, str, bytes, range):
+		digest.update(repr((kind.__name__, value)).encode())
+	elif kind in (list, tuple, set, frozenset):
+		digest.update(repr((kind.__name__, len(value))).encode())
+		for item in (sorted(value, key=repr) if kind in (set, frozenset) else value):
+			content_fingerprint(item, digest)
+	elif kind is dict:
+		digest.update(repr(("dict", len(value))).encode())
+		for key, item in value.items():
+			content_fingerprint(key, digest); content_fingerprint(item, digest)
+	else:
+		digest.update(repr((kind.__module__, kind.__qualname__, id(value))).encode())
+
+	return digest.hexdigest() if top else digest
+
+class IterationMemo:
+	"""
+	Stores the results of Loop iterations so that re-running a Loop can skip the iterations it has already computed.
+	Entries are kept in RAM up to max_bytes, the least recently used ones are then spilled to files in directory
+	with torch.save and loaded back when they are needed again. Entries that can't be saved are dropped instead.
+	"""
+	def __init__(self, directory, max_bytes=ITERATION_MEMO_MAX_BYTES):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict() #key -> (entry, size)
+		self.size = 0
+		self.lock = threading.Lock()
+
+	def path(self, key):
+		return os.path.join(self.directory, hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + ".pt")
+
+	def get(self, key):
+
+		with self.lock:
+			if key in self.entries:
+				self.entries.move_to_end(key)
+				return self.entries[key][0]
+
+		path = self.path(key)
+
+		if not os.path.isfile(path):
+			return None
+
+		try:
+			entry = torch.load(path, map_location="cpu", weights_only=False)
+		except Exception as e:
+			debug_print("Unable to load memoized iteration from", path, ":", e)
+			return None
+
+		if entry.get("key") != key:
+			return None
+
+		self.put(key, entry)
+
+		return entry
+
+	def put(self, key, entry):
+
+		entry["key"] = key
+		size = _result_size(entry)
+
+		with self.lock:
+			if key in self.entries:
+				self.size -= self.entries.pop(key)[1]
+			self.entries[key] = (entry, size)
+			self.size += size
+			evicted = []
+			while self.size > self.max_bytes and len(self.entries) > 1:
+				old_key, (old_entry, old_size) = self.entries.popitem(last=False)
+				self.size -= old_size
+				evicted.append((old_key, old_entry))
+
+		for old_key, old_entry in evicted:
+			path = self.path(old_key)
+			if os.path.isfile(path): #Already spilled before it was loaded back
+				continue
+			try:
+				os.makedirs(self.directory, exist_ok=True)
+				torch.save(old_entry, path + ".tmp")
+				os.replace(path + ".tmp", path)
+			except Exception as e:
+				debug_print("Unable to spill memoized iteration to", path, ":", e)
+				try:
+					os.remove(path + ".tmp")
+				except OSError:
+					pass
+
+	def clear(self):
+
+		with self.lock:
+			self.entries.clear()
+			self.size = 0
+
+		if os.path.isdir(self.directory):
+			for name in os.listdir(self.directory):
+				if name.endswith(".pt"):
+					try:
+						os.remove(os.path.join(self.directory, name))
+					except OSError:
+						pass
 		
 def search_folder(folder_path, pattern, recursive, full_path, include_directories,relative_filenames):
 	
@@ -287,217 +568,1878 @@ default_functions = {
 	'Ellipsis': Ellipsis 
 }
 
-def safe_eval(expr, variables=None, additional_functions=None):
+EXPR_CACHE_SIZE = 256 #How many distinct expressions safe_eval keeps parsed in memory. Loop and IF conditions resend the same text on every iteration.
+
+# Default resource limits for a single safe_eval call. Set any of them to None to disable it.
+EVAL_LIMITS = {
+	"max_steps": 50_000_000, #Comprehension items, function calls and lambda calls evaluated
+	"max_time": 60.0, #Wall-clock seconds
+	"max_size": 10_000_000, #Elements in a range, repeated sequence or comprehension result (bits for integer powers and shifts)
+	"max_depth": 100, #Nested lambda calls
+}
+
+# Node types safe_eval knows how to evaluate, along with the operators, contexts and helper nodes they contain
+supported_nodes = tuple(operators) + (
+	ast.Module, ast.Expr, ast.Expression, ast.Assign, ast.NamedExpr, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare,
+	ast.Constant, ast.Name, ast.Subscript, ast.Slice, ast.Tuple, ast.List, ast.Dict, ast.Call, ast.keyword, ast.Attribute,
+	ast.IfExp, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.comprehension, ast.Lambda, ast.arguments, ast.arg, ast.Load, ast.Store,
+)
+
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def parse_expression(expr):
+	"""
+	Parse an expression into an AST and validate it against the supported node types.
+	The result is cached by source text, use parse_expression.cache_info() to obtain the hit and miss counters.
+	
+	:param expr: The expression to parse as a string.
+	:return: The validated AST of the expression. It is shared between callers and must not be modified.
+	"""
+	node = ast.parse(expr, mode='exec')
+
+	for child in ast.walk(node):
+		if not isinstance(child, supported_nodes):
+			raise TypeError(f"Unsupported type: {type(child)}")
+
+	return node
+
+# EXPRESSION OPTIMIZATION
+#*************************
+FOLD_MAX_LENGTH = 4096 #Constant strings and sequences longer than this are left for evaluation time instead of being folded into the tree
+FOLD_MAX_BITS = 4096 #Constant integers larger than this many bits are left for evaluation time, where the EVAL_LIMITS apply
+
+static_modules = {'math': math, 'random': random, 'torch': torch} #Modules whose attributes are resolved once at compile time
+
+class ConstantSet(frozenset):
+	"""
+	Frozen set of literal values used for folded membership tests. Only plain values are looked up by hash, anything else
+	(such as tensors, which hash by identity but compare elementwise) falls back to the linear search a list would do.
+	"""
+	hashed_types = (int, float, complex, str, bytes, bool, type(None))
+
+	def __contains__(self, item):
+		if type(item) in self.hashed_types:
+			return frozenset.__contains__(self, item)
+		return any(item is value or item == value for value in self)
+
+class ResolvedAttribute(ast.expr):
+	"""
+	Attribute chain on a whitelisted module (e.g. math.pi) that was resolved at compile time.
+	The original node is kept so the lookup can still be performed if the module name is shadowed by a variable.
+	"""
+	_fields = ("original",)
+
+	def __init__(self, original, base, module, value):
+		super().__init__(original=original)
+		self.base, self.module, self.value = base, module, value
+
+def _fold_allowed(op, left, right):
+	"""
+	Check that folding a binary operation on two constants won't produce an oversized value.
+	
+	:param op: The AST operator.
+	:param left: The left constant.
+	:param right: The right constant.
+	:return: True if the operation is cheap enough to perform at compile time.
+	"""
+	numbers = (int, float, complex, bool)
+
+	if isinstance(op, ast.Pow) and type(left) is int and type(right) is int and right > 0:
+		return right * abs(left).bit_length() <= FOLD_MAX_BITS
+	if isinstance(op, ast.Pow) and isinstance(left, numbers) and isinstance(right, numbers):
+		return abs(left) <= 1 or abs(right) <= 128
+	if isinstance(op, ast.LShift) and isinstance(left, int) and isinstance(right, int):
+		return right + abs(left).bit_length() <= FOLD_MAX_BITS
+	if isinstance(op, ast.Mult):
+		for sequence, count in ((left, right), (right, left)):
+			if isinstance(sequence, (str, bytes, tuple)) and isinstance(count, int):
+				return len(sequence) * count <= FOLD_MAX_LENGTH
+	return True
+
+class ExpressionOptimizer(ast.NodeTransformer):
+	"""
+	Folds constant subtrees, turns membership tests against literal lists into set lookups
+	and resolves attribute chains on whitelisted modules.
+	"""
+
+	def fold(self, node, value):
+		if isinstance(value, (str, bytes)) and len(value) > FOLD_MAX_LENGTH:
+			return node
+		return ast.copy_location(ast.Constant(value=value), node)
+
+	def visit_BinOp(self, node):
+		self.generic_visit(node)
+		if isinstance(node.left, ast.Constant) and isinstance(node.right, ast.Constant) and _fold_allowed(node.op, node.left.value, node.right.value):
+			try:
+				return self.fold(node, operators[type(node.op)](node.left.value, node.right.value))
+			except Exception:
+				pass
+		return node
+
+	def visit_UnaryOp(self, node):
+		self.generic_visit(node)
+		if isinstance(node.operand, ast.Constant):
+			try:
+				return self.fold(node, operators[type(node.op)](node.operand.value))
+			except Exception:
+				pass
+		return node
+
+	def visit_BoolOp(self, node):
+		self.generic_visit(node)
+		is_and = isinstance(node.op, ast.And)
+		values = list(node.values)
+
+		while len(values) > 1 and isinstance(values[0], ast.Constant):
+			if bool(values[0].value) != is_and: # False for 'and' and True for 'or' short-circuit the whole expression
+				return values[0]
+			values.pop(0)
+
+		if len(values) == 1:
+			return values[0]
+
+		node.values = values
+		return node
+
+	def visit_Compare(self, node):
+		self.generic_visit(node)
+
+		for i, (operation, comparator) in enumerate(zip(node.ops, node.comparators)):
+			if isinstance(operation, (ast.In, ast.NotIn)) and isinstance(comparator, (ast.List, ast.Tuple)) \
+				and all(isinstance(elt, ast.Constant) for elt in comparator.elts):
+				try:
+					node.comparators[i] = ast.copy_location(ast.Constant(value=ConstantSet(elt.value for elt in comparator.elts)), comparator)
+				except TypeError:
+					pass
+
+		if isinstance(node.left, ast.Constant) and all(isinstance(comparator, ast.Constant) for comparator in node.comparators):
+			try:
+				left = node.left.value
+				for operation, comparator in zip(node.ops, node.comparators):
+					if not operators[type(operation)](left, comparator.value):
+						return self.fold(node, False)
+					left = comparator.value
+				return self.fold(node, True)
+			except Exception:
+				pass
+
+		return node
+
+	def visit_IfExp(self, node):
+		self.generic_visit(node)
+		if isinstance(node.test, ast.Constant):
+			return node.body if node.test.value else node.orelse
+		return node
+
+	def visit_Attribute(self, node):
+		chain, base = [], node
+		while isinstance(base, ast.Attribute):
+			chain.append(base.attr)
+			base = base.value
+
+		if isinstance(base, ast.Name) and base.id in static_modules:
+			value = module = static_modules[base.id]
+			try:
+				for attr in reversed(chain):
+					value = getattr(value, attr)
+			except AttributeError:
+				return node
+			return ast.copy_location(ResolvedAttribute(node, base.id, module, value), node)
+
+		self.generic_visit(node)
+		return node
+
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def optimize_expression(expr):
+	"""
+	Build an optimized copy of the parsed tree of an expression, caching it by source text alongside the parsed one.
+	
+	:param expr: The expression to optimize as a string.
+	:return: The optimized AST, which may contain Constant nodes with ConstantSet values and ResolvedAttribute nodes.
+	"""
+	return ExpressionOptimizer().visit(copy.deepcopy(parse_expression(expr)))
+
+# COMPILED EXPRESSIONS
+#**********************
+# Validated trees are turned once into a tree of closures with the signature fn(ctx, local_vars).
+# ctx carries the variables and functions of the current call, local_vars the innermost scope.
+
+constant_names = {'True': True, 'False': False, 'None': None}
+
+class PendingInputError(NameError):
+	"""Raised when an expression reads a variable whose value is not available yet."""
+
+class EvalLimitError(RuntimeError):
+	"""Raised when an expression exceeds one of its resource limits. The name of the limit is stored in the 'limit' attribute."""
+
+	def __init__(self, limit, message):
+		super().__init__(f"Expression exceeded the '{limit}' limit: {message}")
+		self.limit = limit
+		self.message = message
+
+	def __reduce__(self): #Rebuild from both arguments so the error survives being sent back from a pool worker
+		return type(self), (self.limit, self.message)
+
+class EvalBudget:
+	"""
+	Tracks the resources used by a single evaluation against its limits.
+	
+	:param limits: A dictionary with the same keys as EVAL_LIMITS. Missing or None entries are unlimited.
+	"""
+	__slots__ = ("max_steps", "max_time", "max_size", "max_depth", "deadline", "steps", "depth")
+
+	def __init__(self, limits=None):
+		limits = EVAL_LIMITS if limits is None else {**EVAL_LIMITS, **limits}
+		self.max_steps = limits.get("max_steps") or math.inf
+		self.max_time = limits.get("max_time") or math.inf
+		self.max_size = limits.get("max_size") or math.inf
+		self.max_depth = limits.get("max_depth") or math.inf
+		self.deadline = time.monotonic() + self.max_time
+		self.steps = self.depth = 0
+
+	def step(self):
+		self.steps += 1
+		if self.steps > self.max_steps:
+			raise EvalLimitError("max_steps", f"more than {self.max_steps} steps were evaluated")
+		if not self.steps & 255 and time.monotonic() > self.deadline:
+			raise EvalLimitError("max_time", f"evaluation took longer than {self.max_time} seconds")
+
+	def check_size(self, size, what):
+		if size > self.max_size:
+			raise EvalLimitError("max_size", f"{what} of size {size} is larger than {self.max_size}")
+
+	def enter(self):
+		self.step()
+		self.depth += 1
+		if self.depth > self.max_depth:
+			raise EvalLimitError("max_depth", f"lambda calls are nested deeper than {self.max_depth} levels")
+
+class Scope(dict):
+	"""
+	A layer of local variables on top of an enclosing scope, used by comprehensions and lambda calls.
+	Only the names bound by the layer are stored in it, lookups of any other name fall through to the parent,
+	and assignments always go to the innermost layer.
+	
+	:param parent: The enclosing scope (another Scope or the dictionary of variables of the call).
+	"""
+	__slots__ = ("parent",)
+
+	def __init__(self, parent):
+		self.parent = parent
+
+	def __missing__(self, key):
+		return self.parent[key]
+
+	def __contains__(self, key):
+		return dict.__contains__(self, key) or key in self.parent
+
+	def get(self, key, default=None):
+		return self[key] if key in self else default
+
+class EvalContext:
+	"""
+	Per-call state shared by all the closures of a compiled expression.
+	
+	:param variables: The dictionary of variables the expression was called with.
+	:param functions: The functions (default and additional) available to the expression.
+	:param pending: Names of variables that will be supplied later. Reading one raises PendingInputError.
+	:param budget: The EvalBudget of the evaluation. A new one with the default EVAL_LIMITS is created if omitted.
+	"""
+	__slots__ = ("variables", "functions", "pending", "budget")
+
+	def __init__(self, variables, functions, pending=frozenset(), budget=None):
+		self.variables = variables
+		self.functions = functions
+		self.pending = pending
+		self.budget = EvalBudget() if budget is None else budget
+
+def _compile_target(target):
+	"""
+	Build a function that binds a value to a name or a tuple of names in a scope.
+	
+	:param target: The Name or Tuple node being assigned to.
+	:return: A function taking (local_vars, value).
+	"""
+	if isinstance(target, ast.Tuple):
+		names = []
+		for elt in target.elts:
+			if not isinstance(elt, ast.Name):
+				raise ValueError("Only simple variable assignments are supported")
+			names.append(elt.id)
+		count = len(names)
+
+		def assign_tuple(local_vars, value):
+			if not isinstance(value, (tuple, list)) or len(value) != count:
+				raise ValueError("Mismatch between tuple assignment and values")
+			for name, val in zip(names, value):
+				local_vars[name] = val
+
+		return assign_tuple
+
+	if not isinstance(target, ast.Name):
+		raise ValueError("Only simple variable assignments are supported")
+
+	name = target.id
+
+	def assign_name(local_vars, value):
+		local_vars[name] = value
+
+	return assign_name
+
+def _compile_comprehension_target(target):
+	"""
+	Build a function that binds the current item of a comprehension to its target.
+	
+	:param target: The target node of the comprehension generator.
+	:return: A function taking (local_vars, item).
+	"""
+	if isinstance(target, ast.Name):
+		name = target.id
+
+		def bind_name(local_vars, item):
+			local_vars[name] = item
+
+		return bind_name
+
+	if isinstance(target, ast.Tuple):
+		names = [elt.id for elt in target.elts]
+		count = len(names)
+
+		def bind_tuple(local_vars, item):
+			if not isinstance(item, tuple) or len(item) != count:
+				raise ValueError("Invalid tuple unpacking in comprehension")
+			for name, value in zip(names, item):
+				local_vars[name] = value
+
+		return bind_tuple
+
+	return lambda local_vars, item: None
+
+def _compile_module(node):
+	body = [compile_node(stmt) for stmt in node.body]
+
+	if len(body) == 1:
+		return body[0]
+
+	def module(ctx, local_vars):
+		result = None
+		for stmt in body:
+			result = stmt(ctx, local_vars)
+		return result
+
+	return module
+
+def _compile_expr(node):
+	return compile_node(node.value)
+
+def _compile_expression(node):
+	return compile_node(node.body)
+
+def _compile_assign(node):
+	if len(node.targets) != 1:
+		raise ValueError("Only single target assignments are supported")
+
+	assign, value = _compile_target(node.targets[0]), compile_node(node.value)
+
+	def assignment(ctx, local_vars):
+		result = value(ctx, local_vars)
+		assign(local_vars, result)
+		return result
+
+	return assignment
+
+def _compile_namedexpr(node): # Handling the walrus operator :=
+	assign, value = _compile_target(node.target), compile_node(node.value)
+
+	def named_expression(ctx, local_vars):
+		result = value(ctx, local_vars)
+		assign(local_vars, result)
+		return result
+
+	return named_expression
+
+sequence_types = (list, tuple, str, bytes)
+
+def _compile_binop(node):
+	op, left, right = operators[type(node.op)], compile_node(node.left), compile_node(node.right)
+
+	if isinstance(node.op, ast.Mult):
+
+		def multiply(ctx, local_vars):
+			lhs, rhs = left(ctx, local_vars), right(ctx, local_vars)
+			if type(rhs) is int and isinstance(lhs, sequence_types):
+				ctx.budget.check_size(len(lhs) * rhs, "repeated sequence")
+			elif type(lhs) is int and isinstance(rhs, sequence_types):
+				ctx.budget.check_size(len(rhs) * lhs, "repeated sequence")
+			return lhs * rhs
+
+		return multiply
+
+	if isinstance(node.op, (ast.Pow, ast.LShift)):
+		is_pow = isinstance(node.op, ast.Pow)
+
+		def power(ctx, local_vars):
+			lhs, rhs = left(ctx, local_vars), right(ctx, local_vars)
+			if type(lhs) is int and type(rhs) is int and rhs > 0:
+				ctx.budget.check_size(rhs * abs(lhs).bit_length() if is_pow else rhs, "integer result")
+			return op(lhs, rhs)
+
+		return power
+
+	return lambda ctx, local_vars: op(left(ctx, local_vars), right(ctx, local_vars))
+
+def _compile_unaryop(node):
+	op, operand = operators[type(node.op)], compile_node(node.operand)
+	return lambda ctx, local_vars: op(operand(ctx, local_vars))
+
+def _compile_boolop(node):
+	values = [compile_node(value) for value in node.values]
+
+	if isinstance(node.op, ast.And):
+
+		def and_(ctx, local_vars):
+			for value in values:
+				result = value(ctx, local_vars)
+				if not result:
+					return result
+			return result
+
+		return and_
+
+	def or_(ctx, local_vars):
+		for value in values:
+			result = value(ctx, local_vars)
+			if result:
+				return result
+		return result
+
+	return or_
+
+def _compile_compare(node):
+	left = compile_node(node.left)
+	ops = [operators[type(operation)] for operation in node.ops]
+	comparators = [compile_node(comparator) for comparator in node.comparators]
+
+	if len(ops) == 1:
+		op, right = ops[0], comparators[0]
+
+		def compare(ctx, local_vars):
+			if op(left(ctx, local_vars), right(ctx, local_vars)):
+				return True
+			return False
+
+		return compare
+
+	pairs = list(zip(ops, comparators))
+
+	def compare_chain(ctx, local_vars):
+		lhs = left(ctx, local_vars)
+		for op, comparator in pairs:
+			rhs = comparator(ctx, local_vars)
+			if not op(lhs, rhs):
+				return False
+			lhs = rhs
+		return True
+
+	return compare_chain
+
+def _compile_constant(node):
+	value = node.value
+	return lambda ctx, local_vars: value
+
+def _compile_name(node):
+	name = node.id
+
+	def lookup(ctx, local_vars):
+		if name in local_vars:
+			return local_vars[name]
+		variables = ctx.variables
+		if name in variables:
+			return variables[name]
+		functions = ctx.functions
+		if name in functions:
+			return functions[name]
+		if name in constant_names:
+			return constant_names[name]
+		if name in ctx.pending:
+			raise PendingInputError(f"Variable '{name}' is not available yet", name=name)
+		raise NameError(f"Variable '{name}' is not defined")
+
+	return lookup
+
+def _compile_subscript(node):
+	value, index = compile_node(node.value), compile_node(node.slice)
+	return lambda ctx, local_vars: value(ctx, local_vars)[index(ctx, local_vars)]
+
+def _compile_slice(node):
+	none = lambda ctx, local_vars: None
+	lower = compile_node(node.lower) if node.lower else none
+	upper = compile_node(node.upper) if node.upper else none
+	step = compile_node(node.step) if node.step else none
+	return lambda ctx, local_vars: slice(lower(ctx, local_vars), upper(ctx, local_vars), step(ctx, local_vars))
+
+def _compile_tuple(node):
+	elts = [compile_node(elt) for elt in node.elts]
+	return lambda ctx, local_vars: tuple([elt(ctx, local_vars) for elt in elts])
+
+def _compile_list(node):
+	elts = [compile_node(elt) for elt in node.elts]
+	return lambda ctx, local_vars: [elt(ctx, local_vars) for elt in elts]
+
+def _compile_dict(node):
+	if None in node.keys:
+		raise TypeError(f"Unsupported type: {type(None)}")
+	items = [(compile_node(key), compile_node(value)) for key, value in zip(node.keys, node.values)]
+	return lambda ctx, local_vars: {key(ctx, local_vars): value(ctx, local_vars) for key, value in items}
+
+def _integer_result_bits(function, values, keywords):
+	"""Estimate the number of bits of the integer built by pow, math.factorial, math.comb or math.perm, which C code computes without any chance to interrupt it."""
+	if keywords:
+		try:
+			values = list(inspect.signature(function).bind(*values, **keywords).arguments.values())
+		except (TypeError, ValueError): # The call itself raises
+			return 0
+	if not values or not all(type(value) is int for value in values):
+		return 0
+	if function is pow and len(values) == 2 and values[1] > 0:
+		return values[1] * abs(values[0]).bit_length()
+	if function is math.factorial and len(values) == 1:
+		return values[0] * values[0].bit_length()
+	if function in (math.comb, math.perm) and len(values) == 2 and values[0] > 0:
+		return max(0, min(values[1], values[0] - values[1]) if function is math.comb else values[1]) * values[0].bit_length()
+	return 0
+
+def _compile_call(node):
+	func, args = compile_node(node.func), [compile_node(arg) for arg in node.args]
+	kwargs = [(keyword.arg, compile_node(keyword.value)) for keyword in node.keywords] #A name of None stands for **mapping
+
+	def call(ctx, local_vars):
+		function = func(ctx, local_vars)
+		values = [arg(ctx, local_vars) for arg in args]
+		keywords = {}
+		for name, value in kwargs:
+			if name is None:
+				keywords.update(value(ctx, local_vars))
+			else:
+				keywords[name] = value(ctx, local_vars)
+		if callable(function):
+			budget = ctx.budget
+			budget.step()
+			if function is range:
+				values = range(*values, **keywords)
+				try:
+					budget.check_size(len(values), "range")
+				except OverflowError:
+					budget.check_size(math.inf, "range")
+				return values
+			if function in (pow, math.factorial, math.comb, math.perm):
+				budget.check_size(_integer_result_bits(function, values, keywords), "integer result")
+			return function(*values, **keywords)
+		raise TypeError(f"Unsupported function: {function}")
+
+	return call
+
+def _compile_attribute(node):
+	value, attr = compile_node(node.value), node.attr
+
+	def attribute(ctx, local_vars):
+		obj = value(ctx, local_vars)
+		try:
+			return getattr(obj, attr)
+		except AttributeError:
+			raise AttributeError(f"Attribute '{attr}' not found in {obj}") from None
+
+	return attribute
+
+def _compile_resolved_attribute(node):
+	original, base, module, value = compile_node(node.original), node.base, node.module, node.value
+
+	def resolved_attribute(ctx, local_vars):
+		if base in local_vars or base in ctx.variables or ctx.functions.get(base) is not module:
+			return original(ctx, local_vars)
+		return value
+
+	return resolved_attribute
+
+def _compile_ifexp(node):
+	test, body, orelse = compile_node(node.test), compile_node(node.body), compile_node(node.orelse)
+	return lambda ctx, local_vars: body(ctx, local_vars) if test(ctx, local_vars) else orelse(ctx, local_vars)
+
+def _compile_generators(node):
+	"""
+	Compile the 'for' and 'if' clauses of a comprehension.
+	
+	:param node: A ListComp, SetComp, DictComp or GeneratorExp node.
+	:return: A function taking (ctx, local_vars, first) that yields the scope of every item that passes all the conditions,
+	         where first is the already evaluated iterable of the outermost clause.
+	"""
+	generators = [(compile_node(gen.iter), _compile_comprehension_target(gen.target), [compile_node(cond) for cond in gen.ifs]) for gen in node.generators]
+	depth = len(generators)
+
+	def iterate(ctx, local_vars, first):
+		budget = ctx.budget
+
+		def run(level, local_vars, items):
+			_, bind, conds = generators[level]
+			for item in items:
+				budget.step()
+				new_local_vars = Scope(local_vars)
+				bind(new_local_vars, item)
+				if all(cond(ctx, new_local_vars) for cond in conds):
+					if level+1 == depth:
+						yield new_local_vars
+					else:
+						yield from run(level+1, new_local_vars, generators[level+1][0](ctx, new_local_vars))
+
+		return run(0, local_vars, first)
+
+	return generators[0][0], iterate
+
+def _compile_listcomp(node):
+	elt, (first, iterate) = compile_node(node.elt), _compile_generators(node)
+
+	def listcomp(ctx, local_vars):
+		result, max_size = [], ctx.budget.max_size
+		for scope in iterate(ctx, local_vars, first(ctx, local_vars)):
+			result.append(elt(ctx, scope))
+			if len(result) > max_size:
+				ctx.budget.check_size(len(result), "comprehension result")
+		return result
+
+	return listcomp
+
+def _compile_setcomp(node):
+	elt, (first, iterate) = compile_node(node.elt), _compile_generators(node)
+
+	def setcomp(ctx, local_vars):
+		result, max_size = set(), ctx.budget.max_size
+		for scope in iterate(ctx, local_vars, first(ctx, local_vars)):
+			result.add(elt(ctx, scope))
+			if len(result) > max_size:
+				ctx.budget.check_size(len(result), "comprehension result")
+		return result
+
+	return setcomp
+
+def _compile_dictcomp(node):
+	key, value, (first, iterate) = compile_node(node.key), compile_node(node.value), _compile_generators(node)
+
+	def dictcomp(ctx, local_vars):
+		result, max_size = {}, ctx.budget.max_size
+		for scope in iterate(ctx, local_vars, first(ctx, local_vars)):
+			result[key(ctx, scope)] = value(ctx, scope)
+			if len(result) > max_size:
+				ctx.budget.check_size(len(result), "comprehension result")
+		return result
+
+	return dictcomp
+
+def _compile_generatorexp(node):
+	elt, (first, iterate) = compile_node(node.elt), _compile_generators(node)
+
+	def generatorexp(ctx, local_vars):
+		# Like Python, the outermost iterable is evaluated right away and the rest only as items are requested,
+		# so any(), all(), next() and friends stop as soon as they have their answer
+		scopes = iterate(ctx, local_vars, iter(first(ctx, local_vars)))
+		return (elt(ctx, scope) for scope in scopes)
+
+	return generatorexp
+
+def _compile_lambda(node):
+	arg_names, body = [arg.arg for arg in node.args.args], compile_node(node.body)
+
+	def make_lambda(ctx, local_vars):
+
+		def lambda_func(*args, **kwargs):
+			if not kwargs.keys() <= set(arg_names[len(args):]):
+				raise TypeError(f"Unexpected keyword arguments: {', '.join(sorted(kwargs.keys() - set(arg_names[len(args):])))}")
+			if len(args) + len(kwargs) != len(arg_names):
+				raise TypeError(f"Expected {len(arg_names)} arguments, got {len(args) + len(kwargs)}")
+			lambda_local_vars = Scope(local_vars)
+			lambda_local_vars.update(zip(arg_names, args))
+			lambda_local_vars.update(kwargs)
+			budget = ctx.budget
+			budget.enter()
+			try:
+				return body(ctx, lambda_local_vars)
+			finally:
+				budget.depth -= 1
+
+		return lambda_func
+
+	return make_lambda
+
+node_compilers = {
+	ast.Module: _compile_module,
+	ast.Expr: _compile_expr,
+	ast.Expression: _compile_expression,
+	ast.Assign: _compile_assign,
+	ast.NamedExpr: _compile_namedexpr,
+	ast.BinOp: _compile_binop,
+	ast.UnaryOp: _compile_unaryop,
+	ast.BoolOp: _compile_boolop,
+	ast.Compare: _compile_compare,
+	ast.Constant: _compile_constant,
+	ast.Name: _compile_name,
+	ast.Subscript: _compile_subscript,
+	ast.Slice: _compile_slice,
+	ast.Tuple: _compile_tuple,
+	ast.List: _compile_list,
+	ast.Dict: _compile_dict,
+	ast.Call: _compile_call,
+	ast.Attribute: _compile_attribute,
+	ResolvedAttribute: _compile_resolved_attribute,
+	ast.IfExp: _compile_ifexp,
+	ast.ListComp: _compile_listcomp,
+	ast.SetComp: _compile_setcomp,
+	ast.DictComp: _compile_dictcomp,
+	ast.GeneratorExp: _compile_generatorexp,
+	ast.Lambda: _compile_lambda,
+}
+
+def compile_node(node):
+	"""
+	Compile a validated AST node into a closure taking (ctx, local_vars).
+	
+	:param node: The AST node to compile.
+	:return: The compiled closure.
+	"""
+	try:
+		compiler = node_compilers[type(node)]
+	except KeyError:
+		raise TypeError(f"Unsupported type: {type(node)}") from None
+
+	return compiler(node)
+
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def compile_expression(expr):
+	"""
+	Parse, validate, optimize and compile an expression, caching the compiled closure by its source text.
+	
+	:param expr: The expression to compile as a string.
+	:return: A closure taking (ctx, local_vars) that evaluates the expression.
+	"""
+	return compile_node(optimize_expression(expr))
+
+# FREE VARIABLE ANALYSIS
+#************************
+comprehension_nodes = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+def _target_names(target):
+	return {node.id for node in ast.walk(target) if isinstance(node, ast.Name)}
+
+def _collect_names(node, bound, names):
+	"""
+	Recursively gather the names read by a node that are not bound by an enclosing lambda or comprehension.
+	
+	:param node: The AST node to inspect.
+	:param bound: The set of names bound by the enclosing lambdas and comprehensions.
+	:param names: The set the free names are added to.
+	"""
+	if isinstance(node, ast.Name):
+		if isinstance(node.ctx, ast.Load) and node.id not in bound:
+			names.add(node.id)
+
+	elif isinstance(node, ast.Lambda):
+		_collect_names(node.body, bound | {arg.arg for arg in node.args.args}, names)
+
+	elif isinstance(node, comprehension_nodes):
+		for gen in node.generators:
+			_collect_names(gen.iter, bound, names)
+			bound = bound | _target_names(gen.target)
+			for cond in gen.ifs:
+				_collect_names(cond, bound, names)
+		for child in (node.key, node.value) if isinstance(node, ast.DictComp) else (node.elt,):
+			_collect_names(child, bound, names)
+
+	else:
+		for child in ast.iter_child_nodes(node):
+			_collect_names(child, bound, names)
+
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def expression_names(expr):
+	"""
+	Find the free names an expression reads, i.e. every variable or function it looks up
+	that is not bound by one of its own lambdas or comprehensions. The result is cached by source text.
+	
+	:param expr: The expression to inspect as a string.
+	:return: A frozenset with the names read by the expression.
+	"""
+	names = set()
+	_collect_names(parse_expression(expr), frozenset(), names)
+	return frozenset(names)
+
+# TENSOR FUSION
+#***************
+TENSOR_FUSION = True #Evaluate expressions that only combine tensors and numbers as a single fused function that reuses its intermediate tensors
+TENSOR_FUSION_COMPILE = False #Also pass fused expressions through torch.compile. The first call for every new input signature is slow and requires a working compiler toolchain
+
+# Tensor methods and torch functions allowed in fused expressions. All of them return a new tensor, never a view of their input.
+fusion_methods = frozenset({
+	'abs', 'neg', 'exp', 'expm1', 'log', 'log1p', 'sqrt', 'rsqrt', 'square', 'reciprocal', 'sin', 'cos', 'tanh', 'sigmoid',
+	'floor', 'ceil', 'round', 'clamp', 'clip', 'pow', 'lerp', 'mean', 'std', 'var', 'sum', 'prod', 'amin', 'amax',
+})
+fusion_functions = {getattr(torch, name) for name in fusion_methods | {'maximum', 'minimum'} if hasattr(torch, name)}
+
+# Binary operators of fused expressions and the torch functions used to compute them into an existing tensor
+fusion_operators = {ast.Add: torch.add, ast.Sub: torch.sub, ast.Mult: torch.mul, ast.Div: torch.div, ast.FloorDiv: torch.floor_divide, ast.Mod: torch.remainder, ast.Pow: torch.pow}
+
+def _fuse_binop(node, left, right):
+	op, fused_op, is_div = operators[type(node.op)], fusion_operators[type(node.op)], isinstance(node.op, ast.Div)
+
+	def binop(args):
+		(lhs, lhs_owned), (rhs, rhs_owned) = left(args), right(args)
+		if not isinstance(lhs, torch.Tensor):
+			return op(lhs, rhs), isinstance(rhs, torch.Tensor)
+
+		# Write the result over an intermediate tensor when it already has the right shape and dtype
+		for target, owned in ((lhs, lhs_owned), (rhs, rhs_owned)):
+			if owned and target.shape == torch.broadcast_shapes(lhs.shape, getattr(rhs, 'shape', ())) \
+				and torch.result_type(lhs, rhs) == target.dtype and (target.dtype.is_floating_point or not is_div):
+				return fused_op(lhs, rhs, out=target), True
+
+		return fused_op(lhs, rhs), True
+
+	return binop
+
+def _fuse_node(node, names, modules):
+	"""
+	Lower a node of a tensor expression into a closure that also reports whether its result is an intermediate
+	tensor owned by the expression, which later operations are allowed to overwrite.
+	
+	:param node: The optimized AST node to lower.
+	:param names: The set the variable names read by the expression are added to.
+	:param modules: The set the module names used by the expression are added to.
+	:return: A closure taking the dictionary of arguments and returning (value, owned).
+	"""
+	if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+		value = (node.value, False)
+		return lambda args: value
+
+	if isinstance(node, ast.Name):
+		name = node.id
+		names.add(name)
+		return lambda args: (args[name], False)
+
+	if isinstance(node, ResolvedAttribute) and type(node.value) in (int, float):
+		modules.add(node.base)
+		value = (node.value, False)
+		return lambda args: value
+
+	if isinstance(node, ast.BinOp) and type(node.op) in fusion_operators:
+		return _fuse_binop(node, _fuse_node(node.left, names, modules), _fuse_node(node.right, names, modules))
+
+	if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+		return _fuse_node(node.operand, names, modules)
+
+	if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+		operand = _fuse_node(node.operand, names, modules)
+
+		def negate(args):
+			value, owned = operand(args)
+			if owned:
+				return value.neg_(), True
+			return -value, isinstance(value, torch.Tensor)
+
+		return negate
+
+	if isinstance(node, ast.Call) and not node.keywords:
+		args_ = [_fuse_node(arg, names, modules) for arg in node.args]
+
+		if isinstance(node.func, ast.Attribute) and node.func.attr in fusion_methods:
+			obj, attr = _fuse_node(node.func.value, names, modules), node.func.attr
+
+			def method(args):
+				value = obj(args)[0]
+				if not isinstance(value, torch.Tensor):
+					raise TypeError(f"'{attr}' can only be called on a tensor")
+				return getattr(value, attr)(*[arg(args)[0] for arg in args_]), True
+
+			return method
+
+		if isinstance(node.func, ResolvedAttribute) and node.func.value in fusion_functions:
+			modules.add(node.func.base)
+			function = node.func.value
+			return lambda args: (function(*[arg(args)[0] for arg in args_]), True)
+
+	raise TypeError(f"Unsupported type in tensor expression: {type(node)}")
+
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def fuse_expression(expr):
+	"""
+	Lower an expression made only of arithmetic on tensors and numbers (plus a few elementwise and reduction
+	functions) into a single function that overwrites its own intermediate tensors instead of allocating new ones.
+	
+	:param expr: The expression to lower as a string.
+	:return: A tuple (function taking the values of the variables positionally, variable names, module names), or None if the expression cannot be fused.
+	"""
+	tree = optimize_expression(expr)
+
+	if len(tree.body) != 1 or not isinstance(tree.body[0], ast.Expr):
+		return None
+
+	names, modules = set(), set()
+	try:
+		root = _fuse_node(tree.body[0].value, names, modules)
+	except TypeError:
+		return None
+
+	if not names:
+		return None
+
+	names = tuple(sorted(names))
+
+	def fused(*values):
+		return root(dict(zip(names, values)))[0]
+
+	return fused, names, frozenset(modules)
+
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def compile_fused_expression(expr, signature):
+	"""
+	Compile the fused function of an expression with torch.compile, cached by expression and input signature.
+	
+	:param expr: The expression as a string.
+	:param signature: A tuple with the (dtype, shape, device type) of every tensor input and the type of every scalar one.
+	:return: The compiled function.
+	"""
+	return torch.compile(fuse_expression(expr)[0], dynamic=False)
+
+fusion_compile_failures = set() #(expression, signature) pairs torch.compile failed on, which are run uncompiled from then on
+
+def _eval_fused(expr, variables, functions):
+	"""
+	Evaluate an expression through its fused function if it can be fused and every variable it reads is a tensor or a number.
+	
+	:return: A tuple with the result, or None if the expression must be evaluated normally.
+	"""
+	fused = fuse_expression(expr)
+	if fused is None:
+		return None
+
+	function, names, modules = fused
+
+	for base in modules:
+		if base in variables or functions.get(base) is not static_modules[base]:
+			return None
+
+	values, has_tensor = [], False
+	for name in names:
+		if name not in variables:
+			return None
+		value = variables[name]
+		if isinstance(value, torch.Tensor):
+			has_tensor = True
+		elif type(value) not in (int, float):
+			return None
+		values.append(value)
+
+	if not has_tensor:
+		return None
+
+	with torch.inference_mode():
+		if TENSOR_FUSION_COMPILE:
+			signature = tuple((value.dtype, tuple(value.shape), value.device.type) if isinstance(value, torch.Tensor) else type(value) for value in values)
+			if (expr, signature) not in fusion_compile_failures:
+				try:
+					return (compile_fused_expression(expr, signature)(*values),)
+				except Exception as x:
+					debug_print ("[!] TORCH.COMPILE FAILED:",x,". USING THE UNCOMPILED FUSED EXPRESSION.")
+					fusion_compile_failures.add((expr, signature))
+		return (function(*values),)
+
+# EXPRESSION MEMOIZATION
+#*************************
+MEMOIZE_EXPRESSIONS = False #Reuse the result of pure expressions when they are evaluated again with unchanged variables. Only immutable results are reused, except tensors, which are shared between every caller that gets the memoized result
+MEMO_MAX_BYTES = 256 * 1024**2 #Approximate amount of memory the memoized results may take before the least recently used ones are dropped
+
+# Only calls to the functions and methods listed below are considered pure, anything else may have side effects, draw random numbers or read global state.
+
+# Default functions whose result only depends on their arguments
+pure_functions = frozenset({
+	'abs', 'all', 'any', 'ascii', 'bin', 'bool', 'chr', 'dict', 'divmod', 'enumerate', 'filter', 'float', 'format', 'hex', 'int', 'len',
+	'list', 'map', 'max', 'min', 'oct', 'ord', 'pow', 'range', 'repr', 'reversed', 'round', 'set', 'sorted', 'str', 'sum', 'tuple', 'type',
+	'zip', 'tensor',
+})
+
+# Module functions whose result only depends on their arguments, by their path inside the module
+pure_module_functions = {
+	'math': frozenset(name for name in dir(math) if not name.startswith('_')),
+	'random': frozenset(),
+	'torch': frozenset({
+		'abs', 'add', 'sub', 'subtract', 'mul', 'multiply', 'div', 'divide', 'true_divide', 'floor_divide', 'remainder', 'fmod', 'pow',
+		'neg', 'negative', 'reciprocal', 'exp', 'exp2', 'expm1', 'log', 'log2', 'log10', 'log1p', 'sqrt', 'rsqrt', 'square', 'sin', 'cos',
+		'tan', 'asin', 'acos', 'atan', 'atan2', 'sinh', 'cosh', 'tanh', 'sigmoid', 'floor', 'ceil', 'round', 'trunc', 'frac', 'sign',
+		'clamp', 'clip', 'lerp', 'minimum', 'maximum', 'min', 'max', 'amin', 'amax', 'argmin', 'argmax', 'sum', 'mean', 'median', 'std',
+		'var', 'prod', 'cumsum', 'cumprod', 'logsumexp', 'norm', 'dist', 'dot', 'matmul', 'mm', 'bmm', 'outer', 'einsum', 'softmax',
+		'where', 'eq', 'ne', 'lt', 'le', 'gt', 'ge', 'equal', 'isclose', 'allclose', 'isnan', 'isinf', 'isfinite', 'logical_and',
+		'logical_or', 'logical_not', 'logical_xor', 'all', 'any', 'count_nonzero', 'numel', 'topk', 'sort', 'argsort', 'unique',
+		'cat', 'concat', 'stack', 'reshape', 'flatten', 'squeeze', 'unsqueeze', 'permute', 'transpose', 'flip', 'roll', 'narrow',
+		'split', 'chunk', 'tensor', 'as_tensor', 'zeros', 'ones', 'full', 'zeros_like', 'ones_like', 'full_like', 'arange', 'linspace',
+		'linalg.norm', 'linalg.vector_norm', 'nn.functional.interpolate', 'nn.functional.pad', 'nn.functional.normalize',
+		'nn.functional.relu', 'nn.functional.softmax',
+	}),
+}
+
+# Methods of strings, containers, numbers and tensors that only compute a new value from the object they are called on
+pure_methods = frozenset({
+	'upper', 'lower', 'title', 'capitalize', 'casefold', 'swapcase', 'strip', 'lstrip', 'rstrip', 'split', 'rsplit', 'splitlines',
+	'join', 'replace', 'startswith', 'endswith', 'find', 'rfind', 'index', 'rindex', 'count', 'format', 'zfill', 'center', 'ljust',
+	'rjust', 'partition', 'rpartition', 'removeprefix', 'removesuffix', 'isdigit', 'isalpha', 'isalnum', 'isnumeric', 'isdecimal',
+	'isspace', 'islower', 'isupper', 'istitle', 'encode', 'decode', 'get', 'keys', 'values', 'items', 'copy', 'union', 'intersection',
+	'difference', 'symmetric_difference', 'issubset', 'issuperset', 'isdisjoint', 'is_integer', 'bit_length', 'conjugate',
+	'sum', 'mean', 'median', 'std', 'var', 'prod', 'max', 'min', 'amax', 'amin', 'argmax', 'argmin', 'abs', 'sqrt', 'exp', 'log',
+	'clamp', 'clip', 'round', 'floor', 'ceil', 'pow', 'mul', 'add', 'sub', 'div', 'neg', 'sign', 'sigmoid', 'tanh', 'softmax', 'norm',
+	'matmul', 'eq', 'ne', 'lt', 'le', 'gt', 'ge', 'isnan', 'all', 'any', 'nonzero', 'count_nonzero', 'cumsum', 'topk', 'argsort',
+	'unique', 'float', 'double', 'half', 'int', 'long', 'bool', 'item', 'tolist', 'size', 'dim', 'numel', 'nelement', 'element_size',
+	'is_floating_point', 'reshape', 'view', 'flatten', 'squeeze', 'unsqueeze', 'permute', 'transpose', 't', 'flip', 'expand', 'repeat',
+	'contiguous', 'clone', 'detach', 'cpu', 'to', 'unbind', 'chunk',
+})
+
+def _module_attribute(module, chain):
+	for attr in reversed(chain):
+		module = getattr(module, attr, None)
+	return module
+
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def memo_dependencies(expr):
+	"""
+	Check whether an expression is pure, i.e. it doesn't assign variables and only calls or passes around the functions
+	and methods listed as pure above.
+	
+	:param expr: The expression to inspect as a string.
+	:return: A tuple (names read by the expression, names of the functions and modules it calls), or None if it is not pure.
+	"""
+	tree, called, bound = parse_expression(expr), set(), set()
+	inner = {id(node.value) for node in ast.walk(tree) if isinstance(node, ast.Attribute)}
+
+	for node in ast.walk(tree):
+		if isinstance(node, (ast.Assign, ast.NamedExpr)):
+			return None
+		if isinstance(node, ast.arg) or isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+			bound.add(node.arg if isinstance(node, ast.arg) else node.id)
+
+		# Functions can also be called indirectly, e.g. map(print, items), so every reference to them is checked
+		if isinstance(node, ast.Name) and node.id in default_functions and node.id not in static_modules:
+			if callable(default_functions[node.id]) and node.id not in pure_functions:
+				return None
+			called.add(node.id)
+		elif isinstance(node, ast.Attribute) and id(node) not in inner:
+			chain, base = [], node
+			while isinstance(base, ast.Attribute):
+				chain.append(base.attr)
+				base = base.value
+			if isinstance(base, ast.Name) and base.id in static_modules:
+				if '.'.join(reversed(chain)) not in pure_module_functions[base.id] and callable(_module_attribute(static_modules[base.id], chain)):
+					return None
+				called.add(base.id)
+
+		if not isinstance(node, ast.Call):
+			continue
+
+		func = node.func
+		if isinstance(func, ast.Name):
+			if func.id not in pure_functions:
+				return None
+		elif isinstance(func, ast.Attribute):
+			base = func
+			while isinstance(base, ast.Attribute):
+				base = base.value
+			if not (isinstance(base, ast.Name) and base.id in static_modules) and func.attr not in pure_methods:
+				return None
+		elif not isinstance(func, ast.Lambda):
+			return None
+
+	# A lambda argument or comprehension target named like a function could be bound to anything
+	if not called.isdisjoint(bound):
+		return None
+
+	return expression_names(expr), frozenset(called)
+
+def _fingerprint(value, refs):
+	"""
+	Build a hashable fingerprint of a variable that changes whenever its value changes.
+	Tensors are identified by object and version counter, and a weak reference to them is added to refs.
+	
+	:param value: The value to fingerprint.
+	:param refs: A list the weak references to the tensors found are added to.
+	:return: The fingerprint. TypeError is raised for values that can't be fingerprinted.
+	"""
+	kind = type(value)
+
+	if value is None or kind in (bool, int, float, complex, str, bytes, range):
+		return kind, value
+	if isinstance(value, torch.Tensor):
+		refs.append(weakref.ref(value))
+		return torch.Tensor, id(value), value._version, tuple(value.shape), str(value.dtype), str(value.device)
+	if kind in (list, tuple, set, frozenset):
+		return kind, tuple(_fingerprint(item, refs) for item in value)
+	if kind is dict:
+		return kind, tuple((_fingerprint(key, refs), _fingerprint(item, refs)) for key, item in value.items())
+
+	raise TypeError(f"Can't fingerprint {kind.__name__}")
+
+def _result_size(value, depth=0):
+	if isinstance(value, torch.Tensor):
+		return value.element_size() * value.nelement()
+	size = sys.getsizeof(value)
+	if depth < 3 and isinstance(value, (list, tuple, set, frozenset)):
+		size += sum(_result_size(item, depth+1) for item in value)
+	elif depth < 3 and isinstance(value, dict):
+		size += sum(_result_size(key, depth+1) + _result_size(item, depth+1) for key, item in value.items())
+	return size
+
+def _memoizable(value, depth=0):
+	"""Check whether a result is immutable, or a tensor, and can be returned to more than one caller."""
+	if value is None or type(value) in (bool, int, float, complex, str, bytes, range) or isinstance(value, torch.Tensor):
+		return True
+	if depth < 3 and type(value) in (tuple, frozenset, ConstantSet):
+		return all(_memoizable(item, depth+1) for item in value)
+	return False
+
+class ExpressionMemo:
+	"""
+	Least recently used cache of expression results with a memory budget.
+	Entries keep weak references to the tensors they were computed from, and are ignored once any of them is gone.
+	"""
+
+	def __init__(self):
+		self.entries = OrderedDict()
+		self.size = 0
+		self.hits = self.misses = 0
+
+	def key(self, expr, variables):
+		"""
+		Build the memo key of an expression for the given variables.
+		
+		:return: A tuple (key, weak references to the tensors read), or None if the expression can't be memoized.
+		"""
+		dependencies = memo_dependencies(expr)
+		if dependencies is None:
+			return None
+
+		names, called, refs = *dependencies, []
+		try:
+			fingerprint = tuple((name, _fingerprint(variables[name], refs)) if name in variables else (name,) for name in sorted(names))
+		except TypeError:
+			return None
+
+		# Called functions must be the default ones, not variables with the same name
+		if any(len(entry) > 1 for entry in fingerprint if entry[0] in called):
+			return None
+
+		return (expr, fingerprint), refs
+
+	def get(self, key):
+		entry = self.entries.get(key)
+		if entry is None or any(ref() is None for ref in entry[1]):
+			self.misses += 1
+			return None
+		self.entries.move_to_end(key)
+		self.hits += 1
+		return entry
+
+	def put(self, key, refs, result):
+		# Mutable results (and iterators, which are consumed by their first user) can't be handed out twice
+		if not _memoizable(result):
+			return
+
+		size = _result_size(result)
+		if size > MEMO_MAX_BYTES:
+			return
+
+		previous = self.entries.pop(key, None)
+		if previous is not None:
+			self.size -= previous[2]
+
+		self.entries[key] = (result, refs, size)
+		self.size += size
+
+		while self.size > MEMO_MAX_BYTES:
+			self.size -= self.entries.popitem(last=False)[1][2]
+
+	def clear(self):
+		self.entries.clear()
+		self.size = 0
+
+expression_memo = ExpressionMemo()
+
+# EXPRESSION PROFILING
+#**********************
+EVAL_PROFILING = False #Record how often and how long every distinct expression takes to evaluate. See eval_stats_report()
+PROFILE_SAMPLES = 512 #How many of the most recent timings of each expression are kept to estimate its 95th percentile
+PROFILE_MAX_EXPRESSIONS = 1024 #Expressions seen after this many distinct ones are not recorded
+
+class ExpressionStats:
+	"""Timings recorded for a single expression. Times are in seconds."""
+	__slots__ = ("calls", "errors", "total", "samples", "parse_time", "result_type")
+
+	def __init__(self):
+		self.calls = self.errors = 0
+		self.total = self.parse_time = 0.0
+		self.samples = deque(maxlen=PROFILE_SAMPLES)
+		self.result_type = None
+
+	def p95(self):
+		if not self.samples:
+			return 0.0
+		samples = sorted(self.samples)
+		return samples[min(len(samples)-1, int(len(samples) * 0.95))]
+
+eval_stats = {} #Expression -> ExpressionStats
+eval_stats_lock = threading.Lock()
+
+def _profiled_eval(expr, variables, additional_functions, pending, limits):
+	with eval_stats_lock:
+		stats = eval_stats.get(expr)
+		if stats is None and len(eval_stats) < PROFILE_MAX_EXPRESSIONS:
+			stats = eval_stats[expr] = ExpressionStats()
+
+	if stats is None:
+		return _safe_eval(expr, variables, additional_functions, pending, limits)
+
+	# Compile up front so parsing and compiling are timed separately (the evaluation below then hits the cache)
+	misses, start = compile_expression.cache_info().misses, time.perf_counter()
+	compile_expression(expr)
+	if compile_expression.cache_info().misses != misses:
+		stats.parse_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	try:
+		result = _safe_eval(expr, variables, additional_functions, pending, limits)
+	except Exception:
+		stats.errors += 1
+		raise
+	finally:
+		elapsed = time.perf_counter() - start
+		stats.calls += 1
+		stats.total += elapsed
+		stats.samples.append(elapsed)
+
+	stats.result_type = type(result).__name__
+	return result
+
+def eval_stats_report():
+	"""
+	Summarize the recorded expression timings, slowest in total first. Times are in milliseconds.
+	
+	:return: A list of dictionaries with the expression, calls, errors, total, mean, p95, parse and result_type of each expression.
+	"""
+	with eval_stats_lock:
+		items = list(eval_stats.items())
+
+	report = [{
+		"expression": expr,
+		"calls": stats.calls,
+		"errors": stats.errors,
+		"total": stats.total * 1000,
+		"mean": stats.total * 1000 / stats.calls if stats.calls else 0.0,
+		"p95": stats.p95() * 1000,
+		"parse": stats.parse_time * 1000,
+		"result_type": stats.result_type,
+	} for expr, stats in items]
+
+	return sorted(report, key=lambda entry: entry["total"], reverse=True)
+
+def format_eval_stats(limit=50):
+	"""
+	Format the expression timings as a text table.
+	
+	:param limit: Maximum amount of expressions to list.
+	:return: The table as a string.
+	"""
+	if not EVAL_PROFILING and not eval_stats:
+		return "Expression profiling is disabled. Set EVAL_PROFILING = True in Helpers.py to enable it."
+
+	lines = [f"{'CALLS':>7} {'TOTAL ms':>10} {'MEAN ms':>9} {'P95 ms':>9} {'PARSE ms':>9}  {'RESULT':<10} EXPRESSION"]
+	for entry in eval_stats_report()[:limit]:
+		expression = " ".join(entry["expression"].split())
+		lines.append(f"{entry['calls']:>7} {entry['total']:>10.3f} {entry['mean']:>9.3f} {entry['p95']:>9.3f} {entry['parse']:>9.3f}  {str(entry['result_type']):<10} {expression[:120]}")
+
+	return "\n".join(lines)
+
+def reset_eval_stats():
+	with eval_stats_lock:
+		eval_stats.clear()
+
+def safe_eval(expr, variables=None, additional_functions=None, pending=None, limits=None):
 	"""
 	Safely evaluate a mathematical expression with named variables, including list and dictionary indexing,
-	logical operators, predefined function calls, list comprehensions, and conditionals.
+	logical operators, predefined function calls, list, set and dict comprehensions, generator expressions, and conditionals.
 	
 	:param expr: The expression to evaluate as a string.
 	:param variables: A dictionary of variable names and their values.
 	:param additional_functions: A dictionary of additional functions to support.
+	:param pending: Optional set of variable names that are not available yet. The expression is evaluated with
+	                the usual short-circuit rules and PendingInputError is raised only if its result depends on one of them.
+	:param limits: Optional dictionary overriding entries of EVAL_LIMITS for this call. EvalLimitError is raised when one is exceeded.
 	:return: The result of the evaluated expression.
 	"""
+	if EVAL_PROFILING:
+		return _profiled_eval(expr, variables, additional_functions, pending, limits)
+	return _safe_eval(expr, variables, additional_functions, pending, limits)
+
+def _safe_eval(expr, variables, additional_functions, pending, limits):
 	if variables is None:
 		variables = {}
 
-	if additional_functions is None:
-		additional_functions = {}
-
 	# Merge default functions with additional functions
-	functions = {**default_functions, **additional_functions}
+	functions = {**default_functions, **additional_functions} if additional_functions else default_functions
+
+	# Compile expression into closures (or reuse the cached ones)
+	code = compile_expression(expr)
+
+	# Pure expressions evaluated again on the same variables return their previous result
+	memo = None
+	if MEMOIZE_EXPRESSIONS and not pending and not additional_functions:
+		memo = expression_memo.key(expr, variables)
+		if memo is not None:
+			entry = expression_memo.get(memo[0])
+			if entry is not None:
+				return entry[0]
+
+	# Arithmetic over tensors runs as one fused function instead of one temporary tensor per operation
+	fused = None
+	if TENSOR_FUSION and not pending:
+		try:
+			fused = _eval_fused(expr, variables, functions)
+		except Exception as x:
+			debug_print ("[!] FUSED EVALUATION FAILED:",x,". EVALUATING NORMALLY.")
 
-	# Parse expression into AST
-	node = ast.parse(expr, mode='exec')
+	result = fused[0] if fused is not None else code(EvalContext(variables, functions, pending or frozenset(), EvalBudget(limits)), variables)
 
-	def _eval(node, local_vars=None):
-		if local_vars is None:
-			local_vars = {}
-
-		if isinstance(node, ast.Expression):
-			return _eval(node.body, local_vars)
-		elif isinstance(node, ast.Assign):
-			targets = node.targets
-			if len(targets) != 1:
-				raise ValueError("Only single target assignments are supported")
-			target = targets[0]
-			value = _eval(node.value, local_vars)
-			if isinstance(target, ast.Tuple):
-				if not isinstance(value, (tuple, list)) or len(target.elts) != len(value):
-					raise ValueError("Mismatch between tuple assignment and values")
-				for elt, val in zip(target.elts, value):
-					if not isinstance(elt, ast.Name):
-						raise ValueError("Only simple variable assignments are supported")
-					local_vars[elt.id] = val
-			else:
-				if not isinstance(target, ast.Name):
-					raise ValueError("Only simple variable assignments are supported")
-				local_vars[target.id] = value
-			return value
-		elif isinstance(node, ast.NamedExpr):  # Handling the walrus operator :=
-			target = node.target
-			value = _eval(node.value, local_vars)
-			if isinstance(target, ast.Tuple):
-				if not isinstance(value, (tuple, list)) or len(target.elts) != len(value):
-					raise ValueError("Mismatch between tuple assignment and values")
-				for elt, val in zip(target.elts, value):
-					if not isinstance(elt, ast.Name):
-						raise ValueError("Only simple variable assignments are supported")
-					local_vars[elt.id] = val
+	if memo is not None:
+		expression_memo.put(*memo, result)
+
+	return result
+
+# BATCHED EVALUATION
+#********************
+# Node types and operators that can be lowered to elementwise torch operations over whole columns
+vector_nodes = (ast.Module, ast.Expr, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.Constant, ast.Name, ast.IfExp, ast.Load,
+	ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd, ast.Not, ast.And, ast.Or,
+	ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+def _truthy(value):
+	return value.bool() if isinstance(value, torch.Tensor) else bool(value)
+
+def _kind(value):
+	"""Python type (bool, int or float) that a vectorized value has in the row by row evaluation."""
+	if isinstance(value, torch.Tensor):
+		return bool if value.dtype == torch.bool else float if value.is_floating_point() else int
+	return type(value)
+
+def _as_tensor(value):
+	"""Wrap a Python scalar in a tensor of the matching dtype, since torch would turn Python floats into float32."""
+	if isinstance(value, torch.Tensor):
+		return value
+	return torch.tensor(value, dtype={bool: torch.bool, float: torch.float64}.get(type(value), torch.int64))
+
+def _as_number(value):
+	"""Treat booleans as integers in arithmetic like Python does, torch would apply logical operations to them instead."""
+	if _kind(value) is not bool:
+		return value
+	return value.long() if isinstance(value, torch.Tensor) else int(value)
+
+def _as_float(value):
+	"""Convert an integer operand to float64 like Python converts int to float, refusing integers float64 can't hold exactly."""
+	if _kind(value) is float:
+		return value
+	if bool((torch.as_tensor(value).abs() > 2**53).any()):
+		raise OverflowError("integer too large to convert to float exactly")
+	return value.double() if isinstance(value, torch.Tensor) else float(value)
+
+def _promote(lhs, rhs, true_division=False):
+	"""Bring two operands to the types Python would compute them in: integers, or float64 if either one is a float."""
+	lhs, rhs = _as_number(lhs), _as_number(rhs)
+	if true_division or float in (_kind(lhs), _kind(rhs)):
+		return _as_float(lhs), _as_float(rhs)
+	return lhs, rhs
+
+def _same_kind(values):
+	"""Refuse values of different types, which Python would return as they are for each row while torch would unify them."""
+	if len({_kind(value) for value in values}) > 1:
+		raise TypeError("operands of different types")
+
+def _compile_vector(node):
+	"""
+	Compile a node from the vectorizable subset into a closure over columns, replacing Python's
+	truth-value semantics (and, or, not, chained comparisons, ternaries) with elementwise torch operations.
+	Operands are promoted the way Python promotes them, and anything torch would compute differently
+	(division by zero, int64 overflow, negative or float powers, results of mixed types) raises instead.
+	
+	:param node: The AST node to compile.
+	:return: A closure taking (ctx, local_vars).
+	"""
+	if isinstance(node, ast.Module):
+		return _compile_vector(node.body[0])
+	if isinstance(node, ast.Expr):
+		return _compile_vector(node.value)
+	if isinstance(node, (ast.Constant, ast.Name)):
+		return compile_node(node)
+	if isinstance(node, ast.BinOp):
+		op, left, right = operators[type(node.op)], _compile_vector(node.left), _compile_vector(node.right)
+		true_division, divides, power = isinstance(node.op, ast.Div), isinstance(node.op, (ast.Div, ast.FloorDiv, ast.Mod)), isinstance(node.op, ast.Pow)
+		can_overflow = isinstance(node.op, (ast.Add, ast.Sub, ast.Mult, ast.Pow))
+
+		def arithmetic(ctx, local_vars):
+			lhs, rhs = _promote(left(ctx, local_vars), right(ctx, local_vars), true_division)
+			if not isinstance(lhs, torch.Tensor) and not isinstance(rhs, torch.Tensor):
+				return op(lhs, rhs)
+			lhs, rhs = _as_tensor(lhs), _as_tensor(rhs) # torch divides a scalar by a tensor through its reciprocal, which rounds differently
+			if divides and bool((rhs == 0).any()): # torch returns inf or nan where Python raises, let the row by row evaluation raise instead
+				raise ZeroDivisionError("division by zero")
+			if power and (lhs.dtype == torch.float64 or bool((rhs < 0).any())): # Python's float pow rounds differently and negative powers of integers are floats
+				raise TypeError("power not computed like Python")
+			result = op(lhs, rhs)
+			if can_overflow and _kind(result) is int and bool((op(lhs.double(), rhs.double()).abs() >= 2**62).any()):
+				raise OverflowError("integer result out of the range of int64") # int64 wraps around where Python integers grow
+			return result
+
+		return arithmetic
+	if isinstance(node, ast.UnaryOp):
+		operand = _compile_vector(node.operand)
+		if isinstance(node.op, ast.Not):
+			return lambda ctx, local_vars: torch.logical_not(torch.as_tensor(_truthy(operand(ctx, local_vars))))
+		op = operators[type(node.op)]
+		return lambda ctx, local_vars: op(_as_number(operand(ctx, local_vars)))
+	if isinstance(node, ast.BoolOp):
+		values = [_compile_vector(value) for value in node.values]
+		is_and = isinstance(node.op, ast.And)
+
+		def boolop(ctx, local_vars):
+			result = values[0](ctx, local_vars)
+			for value in values[1:]:
+				other = value(ctx, local_vars)
+				_same_kind((result, other))
+				condition, result, other = torch.as_tensor(_truthy(result)), _as_tensor(result), _as_tensor(other)
+				result = torch.where(condition, other, result) if is_and else torch.where(condition, result, other)
+			return result
+
+		return boolop
+	if isinstance(node, ast.Compare):
+		left = _compile_vector(node.left)
+		pairs = [(operators[type(operation)], _compile_vector(comparator)) for operation, comparator in zip(node.ops, node.comparators)]
+
+		def compare(ctx, local_vars):
+			lhs, result = left(ctx, local_vars), True
+			for op, comparator in pairs:
+				rhs = comparator(ctx, local_vars)
+				result = torch.logical_and(torch.as_tensor(result), torch.as_tensor(op(*_promote(lhs, rhs))))
+				lhs = rhs
+			return result
+
+		return compare
+	if isinstance(node, ast.IfExp):
+		test, body, orelse = _compile_vector(node.test), _compile_vector(node.body), _compile_vector(node.orelse)
+
+		def ifexp(ctx, local_vars):
+			condition, values = torch.as_tensor(_truthy(test(ctx, local_vars))), (body(ctx, local_vars), orelse(ctx, local_vars))
+			_same_kind(values)
+			return torch.where(condition, _as_tensor(values[0]), _as_tensor(values[1]))
+
+		return ifexp
+
+	raise TypeError(f"Unsupported type: {type(node)}")
+
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def compile_vector_expression(expr):
+	"""
+	Compile an expression for columnar evaluation, if it only uses arithmetic, comparisons and logic.
+	
+	:param expr: The expression to compile as a string.
+	:return: A tuple (closure, names read by the expression), or None if the expression cannot be vectorized.
+	"""
+	tree = parse_expression(expr)
+
+	if len(tree.body) != 1 or not isinstance(tree.body[0], ast.Expr):
+		return None
+
+	names = set()
+	for node in ast.walk(tree):
+		if not isinstance(node, vector_nodes):
+			return None
+		if isinstance(node, ast.Constant) and type(node.value) not in (int, float, bool):
+			return None
+		if isinstance(node, ast.Name):
+			names.add(node.id)
+
+	return _compile_vector(tree), frozenset(names)
+
+def _to_column(values):
+	"""
+	Convert a column of bindings to a tensor if every value in it has the same numeric type.
+	Columns mixing types are left for the row by row evaluation, since each row could return a result of a different type.
+	
+	:param values: A list or tensor of values.
+	:return: The column as a tensor, or None if it can't be vectorized.
+	"""
+	if isinstance(values, torch.Tensor):
+		return values if values.dim() > 0 else None
+
+	kinds = set(map(type, values))
+
+	if len(kinds) != 1 or not kinds <= {int, float, bool}:
+		return None
+
+	if int in kinds and any(abs(value) >= 2**62 for value in values): # Leave room for the overflow checks of int64 arithmetic
+		return None
+
+	return torch.tensor(values, dtype={bool: torch.bool, int: torch.int64, float: torch.float64}[kinds.pop()])
+
+def safe_eval_many(expr, rows, variables=None, additional_functions=None, limits=None):
+	"""
+	Evaluate one expression against many sets of bindings, parsing and compiling it only once.
+	Numeric columns are evaluated in a single pass with torch broadcasting whenever the expression
+	only uses arithmetic, comparisons, logical operators and conditionals. Every other case is
+	evaluated row by row with the compiled expression.
+	
+	:param expr: The expression to evaluate as a string.
+	:param rows: Either a list of dictionaries, one per row, or a dictionary of equally sized columns (lists or tensors).
+	:param variables: A dictionary of variables shared by all the rows.
+	:param additional_functions: A dictionary of additional functions to support.
+	:param limits: Optional dictionary overriding entries of EVAL_LIMITS, applied to every row separately.
+	:return: A list with the result of every row, or a tensor if the columns were tensors and the evaluation was vectorized.
+	"""
+	if variables is None:
+		variables = {}
+
+	functions = {**default_functions, **additional_functions} if additional_functions else default_functions
+	ctx = EvalContext(variables, functions, budget=EvalBudget(limits))
+
+	if isinstance(rows, dict):
+
+		lengths = {len(column) for column in rows.values()}
+		if len(lengths) > 1:
+			raise ValueError("All columns must have the same length")
+		count = lengths.pop() if lengths else 0
+
+		vector = compile_vector_expression(expr)
+
+		if vector is not None and count > 0:
+
+			code, names = vector
+			columns = {}
+
+			for name in names:
+				if name in rows:
+					column = _to_column(rows[name])
+					if column is None:
+						break
+					columns[name] = column
+				elif name in variables and type(variables[name]) not in (int, float, bool):
+					break
+				elif name not in variables and name not in constant_names:
+					break
 			else:
-				if not isinstance(target, ast.Name):
-					raise ValueError("Only simple variable assignments are supported")
-				local_vars[target.id] = value
-			return value
-		elif isinstance(node, ast.BinOp):
-			left = _eval(node.left, local_vars)
-			right = _eval(node.right, local_vars)
-			return operators[type(node.op)](left, right)
-		elif isinstance(node, ast.UnaryOp):
-			operand = _eval(node.operand, local_vars)
-			return operators[type(node.op)](operand)
-		elif isinstance(node, ast.BoolOp):
-			if isinstance(node.op, ast.And):
-				for value in node.values:
-					result = _eval(value, local_vars)
-					if not result:
-						return result
-				return result
-			elif isinstance(node.op, ast.Or):
-				for value in node.values:
-					result = _eval(value, local_vars)
-					if result:
+				try:
+					result = code(ctx, columns)
+				except Exception as x:
+					debug_print ("[!] VECTORIZED EVALUATION FAILED:",x,". EVALUATING ROW BY ROW.")
+				else:
+					if not isinstance(result, torch.Tensor) or result.dim() == 0:
+						result = _as_tensor(result).expand(count)
+					if any(isinstance(column, torch.Tensor) for column in rows.values()):
 						return result
-				return result
-		elif isinstance(node, ast.Compare):
-			left = _eval(node.left, local_vars)
-			for operation, comparator in zip(node.ops, node.comparators):
-				right = _eval(comparator, local_vars)
-				if not operators[type(operation)](left, right):
-					return False
-				left = right
-			return True
-		elif isinstance(node, ast.Num):  # For Python 3.8 and earlier
-			return node.n
-		elif isinstance(node, ast.Constant):  # For Python 3.8 and later
-			return node.value
-		elif isinstance(node, ast.Name):
-			if node.id in local_vars:
-				return local_vars[node.id]
-			elif node.id in variables:
-				return variables[node.id]
-			elif node.id in functions:
-				return functions[node.id]
-			elif node.id in {'True', 'False', 'None'}:
-				return {'True': True, 'False': False, 'None': None}[node.id]
-			else:
-				raise NameError(f"Variable '{node.id}' is not defined")
-		elif isinstance(node, ast.Subscript):
-			value = _eval(node.value, local_vars)
-			index = _eval(node.slice, local_vars)
-			return value[index]
-		elif isinstance(node, ast.Index):  # For Python 3.8 and earlier
-			return _eval(node.value, local_vars)
-		elif isinstance(node, ast.Slice):
-			lower = _eval(node.lower, local_vars) if node.lower else None
-			upper = _eval(node.upper, local_vars) if node.upper else None
-			step = _eval(node.step, local_vars) if node.step else None
-			return slice(lower, upper, step)
-		elif isinstance(node, ast.Tuple):
-			return tuple(_eval(elt, local_vars) for elt in node.elts)
-		elif isinstance(node, ast.List):
-			return [_eval(elt, local_vars) for elt in node.elts]
-		elif isinstance(node, ast.Dict):
-			return {_eval(key, local_vars): _eval(value, local_vars) for key, value in zip(node.keys, node.values)}
-		elif isinstance(node, ast.Call):
-			func = _eval(node.func, local_vars)
-			args = [_eval(arg, local_vars) for arg in node.args]
-			if callable(func):
-				return func(*args)
-			else:
-				raise TypeError(f"Unsupported function: {func}")
-		elif isinstance(node, ast.Attribute):
-			value = _eval(node.value, local_vars)
-			if hasattr(value, node.attr):
-				return getattr(value, node.attr)
-			else:
-				raise AttributeError(f"Attribute '{node.attr}' not found in {value}")
-		elif isinstance(node, ast.IfExp):
-			test = _eval(node.test, local_vars)
-			if test:
-				return _eval(node.body, local_vars)
-			else:
-				return _eval(node.orelse, local_vars)
-		elif isinstance(node, ast.ListComp):
-			elt = node.elt
-			generators = node.generators
-			return _eval_listcomp(elt, generators, local_vars)
-		elif isinstance(node, ast.Lambda):
-			return _eval_lambda(node, local_vars)
-		elif isinstance(node, ast.Expr):
-			return _eval(node.value, local_vars)
-		elif isinstance(node, ast.Module):
-			for stmt in node.body:
-				result = _eval(stmt, local_vars)
-			return result
-		elif isinstance(node, ast.Ellipsis):
-			return Ellipsis
-		else:
-			raise TypeError(f"Unsupported type: {type(node)}")
+					return result.tolist()
+
+		rows = [dict(zip(rows, values)) for values in zip(*rows.values())]
+
+	code, results = compile_expression(expr), []
+
+	for row in rows:
+		ctx.budget = EvalBudget(limits)
+		results.append(code(ctx, dict(row)))
+
+	return results
+
+# POOLED EVALUATION
+#********************
+# Heavy pure-Python expressions can be evaluated in a pool of persistent worker processes, which keeps the GIL free for the
+# rest of ComfyUI and allows an expression that runs for too long to be killed. Workers are plain subprocesses that import
+# this file on its own and exchange length-prefixed pickles with us over their stdin and stdout.
+
+POOL_SIZE = max(1, min(4, (os.cpu_count() or 2) // 2)) #Maximum number of worker processes used for pooled evaluation
+POOL_TIMEOUT = 60.0 #Seconds a pooled evaluation may take before its worker is terminated
+
+POOL_BOOTSTRAP = "import sys; sys.path.insert(0, sys.argv[1]); import Helpers; Helpers.pool_worker_main()"
 
-	def _eval_listcomp(elt, generators, local_vars):
+def _write_frame(stream, data):
+	stream.write(struct.pack(">Q", len(data)) + data)
+	stream.flush()
+
+def _read_frame(stream):
+	header = stream.read(8)
+	if len(header) < 8:
+		return None
+	size, = struct.unpack(">Q", header)
+	return stream.read(size)
+
+def pool_worker_main():
+	"""Entry point of a worker process: evaluate every (expression, variables, limits) request received on stdin until it is closed."""
+	requests, replies = sys.stdin.buffer, sys.stdout.buffer
+	sys.stdout = sys.stderr # print() inside expressions must not end up in the reply stream
+
+	while (data := _read_frame(requests)) is not None:
+		try:
+			expr, variables, limits = pickle.loads(data)
+			reply = (True, safe_eval(expr, variables, limits=limits))
+		except Exception as x:
+			reply = (False, x)
+		try:
+			data = pickle.dumps(reply)
+		except Exception as x:
+			data = pickle.dumps((False, RuntimeError(f"{reply[1]!r}" if not reply[0] else f"Result can't be sent back from the worker: {x}")))
+		_write_frame(replies, data)
+
+class _ReplyUnpickler(pickle.Unpickler):
+	"""Workers import this file as the top level module 'Helpers', so classes defined here (such as EvalLimitError) are mapped back to this module."""
+
+	def find_class(self, module, name):
+		return super().find_class(__name__ if module == "Helpers" else module, name)
+
+class PoolWorker:
+	"""A worker process along with the thread that collects its replies."""
+
+	def __init__(self):
+		self.process = subprocess.Popen([sys.executable, "-c", POOL_BOOTSTRAP, os.path.dirname(os.path.abspath(__file__))], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+		self.replies = queue.Queue()
+		threading.Thread(target=self.read_replies, daemon=True).start()
+
+	def read_replies(self):
+		while (data := _read_frame(self.process.stdout)) is not None:
+			self.replies.put(data)
+		self.replies.put(None)
+
+	def alive(self):
+		return self.process.poll() is None
+
+	def evaluate(self, payload, timeout):
+		_write_frame(self.process.stdin, payload)
+		try:
+			data = self.replies.get(timeout=timeout)
+		except queue.Empty:
+			self.kill()
+			raise EvalLimitError("max_time", f"pooled evaluation took longer than {timeout} seconds, its worker process was terminated") from None
+		if data is None:
+			self.kill()
+			raise RuntimeError("The worker process exited during a pooled evaluation")
+		ok, result = _ReplyUnpickler(io.BytesIO(data)).load()
+		if not ok:
+			raise result
+		return result
+
+	def kill(self):
+		if self.alive():
+			self.process.kill()
+		self.process.wait()
+
+class EvalPool:
+	"""
+	Pool of worker processes for safe_eval. Workers are started on first use and reused afterwards.
+	
+	:param size: The maximum number of worker processes.
+	"""
+
+	def __init__(self, size=POOL_SIZE):
+		self.size = size
+		self.idle = queue.LifoQueue()
+		self.slots = threading.BoundedSemaphore(size)
+		self.dispatcher = None
+		self.lock = threading.Lock()
+
+	def evaluate(self, expr, variables=None, timeout=None, limits=None):
 		"""
-		Evaluate a list comprehension.
+		Evaluate an expression in one of the workers, blocking until it finishes.
+		Only the variables read by the expression are sent and they must be picklable. Assignments made by the
+		expression are not reflected in the variables of the caller.
 		
-		:param elt: The element expression of the list comprehension.
-		:param generators: The generators of the list comprehension.
-		:param local_vars: The local variables for the list comprehension.
-		:return: The evaluated list comprehension.
+		:param expr: The expression to evaluate as a string.
+		:param variables: A dictionary of variable names and their values.
+		:param timeout: Seconds to wait for the result before terminating the worker, POOL_TIMEOUT if omitted.
+		:param limits: Optional dictionary overriding entries of EVAL_LIMITS in the worker.
+		:return: The result of the evaluated expression.
 		"""
-		if not generators:
-			return [_eval(elt, local_vars)]
-
-		gen = generators[0]
-		iter_ = _eval(gen.iter, local_vars)
-		result = []
-
-		for item in iter_:
-			new_local_vars = local_vars.copy()
-			if isinstance(gen.target, ast.Name):
-				new_local_vars[gen.target.id] = item
-			elif isinstance(gen.target, ast.Tuple):
-				if isinstance(item, tuple) and len(gen.target.elts) == len(item):
-					for elt, value in zip(gen.target.elts, item):
-						new_local_vars[elt.id] = value
-				else:
-					raise ValueError("Invalid tuple unpacking in list comprehension")
-			if all(_eval(cond, new_local_vars) for cond in gen.ifs):
-				result.extend(_eval_listcomp(elt, generators[1:], new_local_vars))
-
-		return result
+		variables = variables or {}
+		payload = pickle.dumps((expr, {name: variables[name] for name in expression_names(expr) if name in variables}, limits))
 
-	def _eval_lambda(node, local_vars):
+		self.slots.acquire()
+		try:
+			try:
+				worker = self.idle.get_nowait()
+			except queue.Empty:
+				worker = PoolWorker()
+			try:
+				return worker.evaluate(payload, POOL_TIMEOUT if timeout is None else timeout)
+			finally:
+				if worker.alive():
+					self.idle.put(worker)
+		finally:
+			self.slots.release()
+
+	def submit(self, expr, variables=None, timeout=None, limits=None):
 		"""
-		Evaluate a lambda function.
+		Start evaluating an expression in one of the workers without waiting for it. Takes the same arguments as evaluate().
 		
-		:param node: The lambda node.
-		:param local_vars: The local variables for the lambda function.
-		:return: The evaluated lambda function.
+		:return: A concurrent.futures.Future with the result.
 		"""
-		if not isinstance(node, ast.Lambda):
-			raise TypeError(f"Expected ast.Lambda, got {type(node)}")
+		with self.lock:
+			if self.dispatcher is None:
+				self.dispatcher = concurrent.futures.ThreadPoolExecutor(self.size, thread_name_prefix="safe_eval_pool")
+		return self.dispatcher.submit(self.evaluate, expr, variables, timeout, limits)
+
+	def shutdown(self):
+		"""Terminate all the idle workers. Busy ones are terminated when their evaluation finishes or times out."""
+		while True:
+			try:
+				self.idle.get_nowait().kill()
+			except queue.Empty:
+				break
+
+eval_pool = EvalPool()
+
+def safe_eval_pooled(expr, variables=None, timeout=None, limits=None):
+	"""
+	Evaluate an expression in the shared pool of worker processes. See EvalPool.evaluate().
+	"""
+	return eval_pool.evaluate(expr, variables, timeout, limits)
+
+# STATE SNAPSHOTS
+#****************
+
+# Snapshots save a dictionary of state to a folder so it can be restored after ComfyUI restarts. The structure of the state is
+# written as JSON, tensors found anywhere in it are stored in a safetensors file (or with torch.save when safetensors is not
+# installed) and any other object that JSON can't represent is pickled. Every save writes a new generation of files and only
+# replaces the JSON file once all of them are complete, so an interrupted save leaves the previous snapshot intact.
+
+def _encode_snapshot(value, tensors, objects):
+
+	kind = type(value)
+
+	if isinstance(value, torch.Tensor):
+		name = str(len(tensors))
+		tensors[name] = value.detach().to("cpu", copy=True).contiguous()
+		return {"__tensor__": name}
+	if value is None or kind in (bool, int, float, str):
+		return value
+	if kind is list:
+		return [_encode_snapshot(item, tensors, objects) for item in value]
+	if kind is tuple:
+		return {"__tuple__": [_encode_snapshot(item, tensors, objects) for item in value]}
+	if kind is dict and all(type(key) is str for key in value):
+		return {"__dict__": {key: _encode_snapshot(item, tensors, objects) for key, item in value.items()}}
+
+	name = str(len(objects))
+	objects[name] = value
+	return {"__object__": name}
+
+def _decode_snapshot(value, tensors, objects):
+
+	if isinstance(value, list):
+		return [_decode_snapshot(item, tensors, objects) for item in value]
+	if not isinstance(value, dict):
+		return value
+	if "__tensor__" in value:
+		return tensors[value["__tensor__"]]
+	if "__tuple__" in value:
+		return tuple(_decode_snapshot(item, tensors, objects) for item in value["__tuple__"])
+	if "__dict__" in value:
+		return {key: _decode_snapshot(item, tensors, objects) for key, item in value["__dict__"].items()}
+	return objects.get(value["__object__"])
+
+def _write_atomic(path, write):
+	try:
+		write(path + ".tmp")
+		os.replace(path + ".tmp", path)
+	finally:
+		if os.path.exists(path + ".tmp"):
+			os.remove(path + ".tmp")
 
-		arg_names = [arg.arg for arg in node.args.args]
+def save_snapshot(directory, name, state):
+	"""
+	Save a dictionary of state under the given name, replacing any previous snapshot with the same name.
+	Objects that can't be pickled (such as loaded models) are restored as None.
+	
+	:param name: Name of the snapshot. Only letters, digits, '-' and '_' should be used.
+	"""
+	tensors, objects = {}, {}
+	encoded = _encode_snapshot(state, tensors, objects)
 
-		def lambda_func(*args):
-			if len(args) != len(arg_names):
-				raise TypeError(f"Expected {len(arg_names)} arguments, got {len(args)}")
-			lambda_local_vars = local_vars.copy()
-			lambda_local_vars.update(zip(arg_names, args))
-			return _eval(node.body, lambda_local_vars)
+	for key, value in list(objects.items()):
+		try:
+			objects[key] = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+		except Exception as e:
+			debug_print("Unable to save", type(value).__name__, "in snapshot", name, ":", e)
+			objects[key] = pickle.dumps(None)
 
-		return lambda_func
+	os.makedirs(directory, exist_ok=True)
+
+	generation = "%s.%d" % (name, time.time_ns())
+	files = {"tensors": None, "objects": None}
+
+	if tensors:
+		if safetensors is not None:
+			files["tensors"] = generation + ".safetensors"
+			_write_atomic(os.path.join(directory, files["tensors"]), lambda path: safetensors.torch.save_file(tensors, path))
+		else:
+			files["tensors"] = generation + ".pt"
+			_write_atomic(os.path.join(directory, files["tensors"]), lambda path: torch.save(tensors, path))
+
+	def write_objects(path):
+		with open(path, "wb") as file:
+			pickle.dump(objects, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+	if objects:
+		files["objects"] = generation + ".pkl"
+		_write_atomic(os.path.join(directory, files["objects"]), write_objects)
+
+	def write_state(path):
+		with open(path, "w", encoding="utf-8") as file:
+			json.dump({"version": 1, "files": files, "state": encoded}, file)
+
+	_write_atomic(os.path.join(directory, name + ".json"), write_state)
+
+	for entry in os.listdir(directory): #Remove the files of older generations
+		if entry.startswith(name + ".") and entry != name + ".json" and entry not in files.values() and not entry.endswith(".tmp"):
+			try:
+				os.remove(os.path.join(directory, entry))
+			except OSError:
+				pass
+
+def load_snapshot(directory, name):
+	"""
+	Load the state saved under the given name.
+	
+	:return: The state dictionary, or None if there is no snapshot with that name or it can't be read.
+	"""
+	path = os.path.join(directory, name + ".json")
+
+	if not os.path.isfile(path):
+		return None
+
+	try:
+		with open(path, "r", encoding="utf-8") as file:
+			snapshot = json.load(file)
+
+		files, tensors, objects = snapshot["files"], {}, {}
+
+		if files.get("tensors"):
+			tensors_path = os.path.join(directory, files["tensors"])
+			if tensors_path.endswith(".safetensors"):
+				if safetensors is None:
+					raise Exception("safetensors is required to load this snapshot")
+				tensors = safetensors.torch.load_file(tensors_path)
+			else:
+				tensors = torch.load(tensors_path, map_location="cpu")
+
+		if files.get("objects"):
+			with open(os.path.join(directory, files["objects"]), "rb") as file:
+				objects = {key: pickle.loads(value) for key, value in pickle.load(file).items()}
+
+		return _decode_snapshot(snapshot["state"], tensors, objects)
 
-	return _eval(node, variables)
+	except Exception as e:
+		debug_print("Unable to load snapshot", name, "from", directory, ":", e)
+		return None
 
 """
 # Example usage:
@@ -19,6 +19,7 @@ NODE_CLASS_MAPPINGS = {
 	"UniversalSwitch": ControlFlowUtils.UniversalSwitch,
 	"LoopOpen": ControlFlowUtils.LoopOpen,
 	"LoopClose": ControlFlowUtils.LoopClose,
+	"LoopGather": ControlFlowUtils.LoopGather,
 	"Cycle": ControlFlowUtils.Cycle,
 	"CycleContinue": ControlFlowUtils.CycleContinue,
 	"CycleEnd": ControlFlowUtils.CycleEnd,
@@ -49,6 +50,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
 	"UniversalSwitch": "💠 Universal Switch",
 	"LoopOpen": "🔃 Loop Open",
 	"LoopClose": "⏹️ Loop Close",
+	"LoopGather": "🧺 Loop Gather",
 	"Cycle": "🔄 Cycle",
 	"CycleContinue": "⏩ Cycle Continue",
 	"CycleEnd": "⏪ Cycle Finish",
@@ -0,0 +1,34 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Helpers
+from Helpers import safe_eval, safe_eval_many
+
+class SafeEvalManyTests(unittest.TestCase):
+
+	columns = {"a": [1, 2, 3, 7, -4], "b": [2, 5, 1, 3, 6], "x": [0.1, 2.5, -3.75, 1e-3, 7.0], "flag": [True, False, True, True, False]}
+
+	def evaluate_rows(self, expr):
+		return [safe_eval(expr, dict(zip(self.columns, values))) for values in zip(*self.columns.values())]
+
+	def test_matches_safe_eval(self):
+		for expr in ["a / 3", "a ** 0.5", "a * 0.1", "a + 0.1", "a / b", "a // b", "a % b", "a ** 2", "a ** -1", "-a", "x * a - b",
+			"a > 1 and b > 1", "a > 1 or b > 4", "flag and a > 1", "flag or flag", "not flag", "(a > 1) + (b > 1)",
+			"0.1 if a > 1 else 0.2", "a if flag else b", "1 < a <= 3", "a == 1.0"]:
+			with self.subTest(expr=expr):
+				expected, results = self.evaluate_rows(expr), safe_eval_many(expr, self.columns)
+				self.assertEqual(results, expected)
+				self.assertEqual([type(result) for result in results], [type(result) for result in expected])
+
+	def test_vectorizes_int_columns(self):
+		with mock.patch.object(Helpers, "debug_print") as fallback:
+			self.assertEqual(safe_eval_many("a / 3", {"a": [1, 2]}), [1/3, 2/3])
+			self.assertEqual(safe_eval_many("a * 0.1", {"a": [1, 2]}), [0.1, 0.2])
+			fallback.assert_not_called()
+
+if __name__ == "__main__":
+	unittest.main()